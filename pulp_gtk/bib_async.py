@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+import asyncio
+import codecs
+import ssl
+import threading
+import time
+import traceback
+import urllib.parse
+
+from gi.repository import GLib
+
+from . import bib_fetcher
+
+############################################################
+# Minimal HTTP/1.1 client on top of asyncio streams
+############################################################
+
+class HttpError(Exception):
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+USER_AGENT = "Python-urllib/3"
+
+async def http_get(url, headers=(), proxy=None, proxy_auth=None,
+                   max_redirects=5, until=None):
+    """
+    Fetch url and return (status, headers, body). Redirects are
+    followed like urllib.request.urlopen does. Status codes >= 400
+    raise HttpError. If until is given, the body is decoded as it
+    arrives and the download stops once the scanner made by until()
+    (see bib_fetcher.MarkerScanner) is fed the chunk it waits for.
+    """
+    for _ in range(max_redirects + 1):
+        status, resp_headers, body = await http_get_once(
+            url, headers, proxy, proxy_auth, until)
+        location = resp_headers.get("location")
+        if status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if status >= 400:
+            raise HttpError("HTTP %d for %s" % (status, url), status)
+        return status, resp_headers, body
+    raise HttpError("Too many redirects for %s" % url)
+
+async def http_get_once(url, headers, proxy, proxy_auth, until=None):
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    ssl_context = ssl.create_default_context() if https else None
+    extra = list(headers)
+    if proxy is None:
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context)
+    else:
+        proxy_host, proxy_port = proxy.rsplit(":", 1)
+        reader, writer = await asyncio.open_connection(
+            proxy_host, int(proxy_port))
+    try:
+        if proxy is not None:
+            if https:
+                await http_connect_tunnel(
+                    reader, writer, host, port, proxy_auth)
+                await writer.start_tls(ssl_context, server_hostname=host)
+            else:
+                target = url
+                if proxy_auth:
+                    extra.append(("Proxy-Authorization", proxy_auth))
+        lines = ["GET %s HTTP/1.1" % target,
+                 "Host: %s" % parts.netloc,
+                 "User-Agent: %s" % USER_AGENT,
+                 "Accept-Encoding: identity",
+                 "Connection: close"]
+        lines += ["%s: %s" % header for header in extra]
+        request = "\r\n".join(lines) + "\r\n\r\n"
+        writer.write(request.encode("latin-1"))
+        await writer.drain()
+        status, resp_headers = await read_response_head(reader)
+        if until is None or status != 200:
+            body = await read_response_body(reader, resp_headers)
+        else:
+            body = await read_response_until(reader, resp_headers, until)
+        return status, resp_headers, body
+    finally:
+        writer.close()
+
+async def http_connect_tunnel(reader, writer, host, port, proxy_auth):
+    lines = ["CONNECT %s:%d HTTP/1.1" % (host, port),
+             "Host: %s:%d" % (host, port)]
+    if proxy_auth:
+        lines.append("Proxy-Authorization: %s" % proxy_auth)
+    request = "\r\n".join(lines) + "\r\n\r\n"
+    writer.write(request.encode("latin-1"))
+    await writer.drain()
+    status, _ = await read_response_head(reader)
+    if status != 200:
+        raise HttpError("Proxy CONNECT failed with HTTP %d" % status)
+
+async def read_response_head(reader):
+    status_line = await reader.readline()
+    parts = status_line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise HttpError("Bad status line: %r" % status_line)
+    status = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, val = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = val.strip()
+    return status, headers
+
+async def read_response_body(reader, headers):
+    chunks = []
+    async for chunk in iter_response_body(reader, headers):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+async def read_response_until(reader, headers, until):
+    enc = content_charset(headers) or "utf-8"
+    decoder = codecs.getincrementaldecoder(enc)(errors="replace")
+    scanner = until()
+    chunks = []
+    async for chunk in iter_response_body(reader, headers):
+        chunks.append(chunk)
+        if scanner.feed(decoder.decode(chunk)):
+            break
+    return b"".join(chunks)
+
+async def iter_response_body(reader, headers, chunk_size=16384):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            yield await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = await reader.read(min(chunk_size, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(chunk, remaining)
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def content_charset(headers):
+    content_type = headers.get("content-type", "")
+    for param in content_type.split(";")[1:]:
+        key, _, val = param.strip().partition("=")
+        if key.lower() == "charset":
+            return val.strip('"')
+    return None
+
+############################################################
+
+class AsyncBibFetcher(bib_fetcher.BibFetcher):
+    """
+    BibFetcher whose network lookups run as coroutines, one per
+    source. After fetch() completes, the memoized properties
+    (bibtex, bib_status, ...) are filled and never hit the network.
+    """
+
+    ########################################################
+    # Fetch all the bibtex
+    ########################################################
+
+    async def fetch(self):
+        loop = asyncio.get_running_loop()
+        local_bib = await loop.run_in_executor(
+            None, lambda: self.local_bib)
+        if local_bib:
+            return self.bibtex
+        if not self.rgx.match(self.filename):
+            arxiv_id = await loop.run_in_executor(
+                None, lambda: self.arxiv_id_from_pdf)
+            if arxiv_id is not None:
+                await self.arxiv_data_async()
+        if self.is_good:
+            await asyncio.gather(
+                self.doi_or_search_async(),
+                self.arxiv_bib_async())
+        else:
+            await self.doi_bib_async()
+        return self.bibtex
+
+    async def doi_or_search_async(self):
+        if not await self.doi_bib_async():
+            await asyncio.gather(
+                self.msn_bib_async(),
+                self.zbmath_bib_async())
+
+    ########################################################
+    # Fetch bibtex through the DOI
+    ########################################################
+
+    async def doi_bib_async(self):
+        if not hasattr(self, "_doi_bib"):
+            loop = asyncio.get_running_loop()
+            doi = await loop.run_in_executor(
+                None, lambda: self.doi_from_pdf)
+            if doi is None:
+                self._doi_bib = ""
+            else:
+                bib = await self.get_html_async(
+                    self.doi_url, headers=self.doi_headers, source="doi")
+                self._doi_bib = self.doi_bib_result(bib)
+        return self._doi_bib
+
+    ########################################################
+    # Fetch MathSciNet bibtex
+    ########################################################
+
+    async def msn_bib_async(self):
+        if not hasattr(self, "_msn_bib"):
+            use_year = True
+            bibs = await self.msn_bib_aux_async(
+                self.msn_url("bibtex", use_year), self.msn_rgx_bibtex)
+            if not bibs and self.year is not None:
+                use_year = False
+                bibs = await self.msn_bib_aux_async(
+                    self.msn_url("bibtex", use_year), self.msn_rgx_bibtex)
+            if bibs:
+                bibs += await self.msn_bib_aux_async(
+                    self.msn_amsrefs_url(bibs, use_year),
+                    self.msn_rgx_amsrefs)
+            self._msn_bib = self.msn_bib_result(bibs)
+        return self._msn_bib
+
+    async def msn_bib_aux_async(self, url, regex):
+        html = await self.get_html_async(
+            url, use_proxy=True, source="msn", until=self.msn_page_done)
+        return self.msn_bib_extract(html, regex)
+
+    ########################################################
+    # Fetch zbMATH bibtex
+    ########################################################
+
+    async def zbmath_bib_async(self):
+        if not hasattr(self, "_zbmath_bib"):
+            self._zbmath_bib = await self.zbmath_bib_aux_async()
+        return self._zbmath_bib
+
+    async def zbmath_bib_aux_async(self):
+        searches = [asyncio.ensure_future(self.zbmath_search_async(url))
+                    for url in self.zbmath_search_urls]
+        bib_urls = []
+        try:
+            for search in asyncio.as_completed(searches):
+                bib_urls = await search
+                if bib_urls:
+                    break
+        finally:
+            for search in searches:
+                search.cancel()
+        bibs = await asyncio.gather(
+            *[self.get_html_async(url, source="zbmath")
+              for url in bib_urls])
+        return self.zbmath_bib_result(bibs)
+
+    async def zbmath_search_async(self, url):
+        html = await self.get_html_async(url, source="zbmath")
+        return self.zbmath_bib_urls(html)
+
+    ########################################################
+    # Fetch arXiv bibtex
+    ########################################################
+
+    async def arxiv_bib_async(self):
+        await self.arxiv_data_async()
+        return self.arxiv_bib
+
+    async def arxiv_id_async(self):
+        if not hasattr(self, "_arxiv_id"):
+            loop = asyncio.get_running_loop()
+            arxiv_id = await loop.run_in_executor(
+                None, lambda: self.arxiv_id_from_pdf)
+            if arxiv_id is None:
+                atom = await self.get_html_async(
+                    self.arxiv_atom_url, source="arxiv",
+                    until=self.arxiv_search_done)
+                arxiv_id = self.arxiv_id_from_atom(atom)
+            self._arxiv_id = arxiv_id
+        return self._arxiv_id
+
+    async def arxiv_data_async(self):
+        if not hasattr(self, "_arxiv_data"):
+            if await self.arxiv_id_async() is None:
+                data = {}
+            elif self.arxiv_entry is not None:
+                data = self.arxiv_entry
+            else:
+                atom = await self.get_html_async(
+                    self.arxiv_id_url, source="arxiv",
+                    until=self.arxiv_entry_done)
+                data = self.arxiv_data_from_atom(atom)
+            self._arxiv_data = data
+        return self._arxiv_data
+
+    ########################################################
+    # Url opener with proxy
+    ########################################################
+
+    async def get_html_async(self, url, use_proxy=False, headers=None,
+                             source=None, until=None):
+        url = url.replace(' ', '%20')
+        proxy = self.proxy_host if use_proxy and self.proxy_host else None
+        start = time.monotonic()
+        status = None
+        for try_num in range(10):
+            self.cancel_token.check()
+            try:
+                status, resp_headers, body = await asyncio.wait_for(
+                    http_get(url, (headers or {}).items(),
+                             proxy=proxy, proxy_auth=self.proxy_auth,
+                             until=until),
+                    self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except HttpError as e:
+                status = e.status
+                if e.status in self.fatal_http_codes:
+                    break
+                continue
+            except Exception:
+                status = None
+                continue
+            else:
+                break
+        else:
+            self.trace_fetch(source, url, start, try_num, status, 0)
+            return None
+        if status is None or status >= 400:
+            self.trace_fetch(source, url, start, try_num, status, 0)
+            return None
+        self.trace_fetch(source, url, start, try_num, status, len(body))
+        enc = content_charset(resp_headers) or "utf-8"
+        return body.decode(enc, errors="replace")
+
+############################################################
+
+class BibEngine:
+    """
+    A single asyncio event loop running in a daemon thread. All the
+    AsyncBibFetcher lookups are multiplexed on it; results are handed
+    back to the GLib main loop with GLib.idle_add.
+    """
+
+    instance = None
+    max_concurrent = 32
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        thread = threading.Thread(
+            target = self.loop.run_forever,
+            daemon = True)
+        thread.start()
+
+    def submit(self, coro, callback=None, *args):
+        future = asyncio.run_coroutine_threadsafe(
+            self.limited(coro), self.loop)
+        def done(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                traceback.print_exception(future.exception())
+            elif callback is not None:
+                GLib.idle_add(callback, future.result(), *args)
+        future.add_done_callback(done)
+        return future
+
+    async def limited(self, coro):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self.semaphore:
+            return await coro
+
+    def fetch_many(self, paths, callback=None, *args, cancel_token=None):
+        """
+        Look up the bibtex of every path concurrently. The result
+        (and the callback argument) is the list of AsyncBibFetcher
+        objects, in the same order as paths.
+        """
+        fetchers = [AsyncBibFetcher(path, cancel_token) for path in paths]
+        async def run_all():
+            await asyncio.gather(
+                *[self.limited(fetcher.fetch()) for fetcher in fetchers],
+                return_exceptions=True)
+            return fetchers
+        future = asyncio.run_coroutine_threadsafe(run_all(), self.loop)
+        if callback is not None:
+            def done(future):
+                # The fetchers that completed keep their results even if
+                # the run was cancelled or failed
+                if not future.cancelled() and future.exception() is not None:
+                    e = future.exception()
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                GLib.idle_add(callback, fetchers, *args)
+            future.add_done_callback(done)
+        return future
+
+############################################################
+
+class AsyncThreadedBibFetcher(bib_fetcher.ThreadedBibFetcher):
+    """
+    Drop-in replacement for ThreadedBibFetcher that runs the lookup on
+    the shared BibEngine instead of a dedicated thread.
+    """
+
+    def check_fetcher(self):
+        if self.bib_fetcher is None:
+            self.bib_fetcher = AsyncBibFetcher(self.path, self.cancel_token)
+
+    def run_thread(self):
+        if self.worker_running:
+            return
+        self.worker_running = True
+        future = BibEngine.get().submit(self.engine_worker(self.bib_fetcher))
+        # Cancelling the task also aborts the request in flight
+        self.cancel_token.on_cancel(future.cancel)
+
+    async def engine_worker(self, fetcher):
+        loop = asyncio.get_running_loop()
+        def read_local():
+            fetcher.cache_bib
+            fetcher.personal_bib
+        try:
+            await loop.run_in_executor(None, read_local)
+            GLib.idle_add(self.worker_first_callback)
+            await fetcher.fetch()
+            self.cancel_token.check()
+        except bib_fetcher.FetchCancelled:
+            return
+        await loop.run_in_executor(None, fetcher.save_cache_bib)
+        GLib.idle_add(self.worker_first_callback)
+        GLib.idle_add(self.worker_callback)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of the BibFetcher lookups against bib_stub_server.
+
+A synthetic library of empty files named like the real one
+(Authors_Year_Title.pdf, some carrying a DOI or an arXiv link) is
+looked up end to end. The per-source latency (from bib_stats), the
+number of requests per lookup (from the stub) and the lookups per
+second are reported.
+
+    python3 -m pulp_gtk.bib_benchmark --lookups 200 --engine async \\
+            --latency msn=0.3,zbmath=0.2,arxiv=0.2,doi=0.1
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import time
+import urllib.request
+
+from . import bib_async
+from . import bib_fetcher
+from . import bib_local
+from . import bib_stub_server
+
+############################################################
+# Synthetic library
+############################################################
+
+AUTHORS = ["Atiyah", "Bott", "Deligne", "Grothendieck", "Hirzebruch",
+           "Kontsevich", "Milnor", "Quillen", "Serre", "Thom", "Witten"]
+
+WORDS = ["cohomology", "sheaves", "moduli", "spaces", "of", "curves",
+         "on", "the", "topology", "algebraic", "varieties", "index",
+         "theorem", "for", "elliptic", "operators", "characteristic",
+         "classes", "stable", "homotopy", "groups", "spheres"]
+
+def make_library(directory, size, doi_rate, arxiv_rate, seed=0):
+    rnd = random.Random(seed)
+    paths = []
+    for n in range(size):
+        authors = rnd.sample(AUTHORS, rnd.randint(1, 3))
+        year = str(rnd.randint(1950, 2020)) if rnd.random() > 0.1 else ""
+        title = " ".join(rnd.sample(WORDS, rnd.randint(3, 7)))
+        title = title.capitalize() + " " + str(n)
+        name = "_".join(authors) + "_" + year + "_" + title + ".pdf"
+        name = name.replace(" ", "_")
+        content = "%PDF-1.4\n"
+        if rnd.random() < doi_rate:
+            content += "<prism:doi>10.9999/stub.%d</prism:doi>\n" % n
+        elif rnd.random() < arxiv_rate:
+            content += "/URI(http://arxiv.org/abs/1601.%05d)\n" % n
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="latin-1") as doc_file:
+            doc_file.write(content)
+        paths.append(path)
+    return paths
+
+############################################################
+# Runners
+############################################################
+
+def run_threaded(paths, concurrency):
+    def lookup(path):
+        fetcher = bib_fetcher.BibFetcher(path)
+        fetcher.bibtex
+        return fetcher
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lookup, paths))
+
+def run_async(paths, concurrency):
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        async def lookup(path):
+            fetcher = bib_async.AsyncBibFetcher(path)
+            async with semaphore:
+                await fetcher.fetch()
+            return fetcher
+        return await asyncio.gather(*[lookup(path) for path in paths])
+    return asyncio.run(run_all())
+
+def point_fetchers_at(roots):
+    attrs = {"MSN_ROOT": "msn_root",
+             "ZBMATH_ROOT": "zbmath_root",
+             "ARXIV_API_ROOT": "arxiv_api_root",
+             "DOI_ROOT": "doi_root",
+             "PROXY": "proxy_host"}
+    for key, attr in attrs.items():
+        setattr(bib_fetcher.BibFetcher, attr, roots[key])
+
+############################################################
+# Report
+############################################################
+
+def report(engine, concurrency, fetchers, elapsed, stats, server_stats):
+    lookups = len(fetchers)
+    requests = sum(s["requests"] for s in server_stats.values())
+    print("engine: %s   lookups: %d   concurrency: %d"
+          % (engine, lookups, concurrency))
+    print("elapsed: %.2f s   lookups/s: %.1f   requests/lookup: %.2f"
+          % (elapsed, lookups / elapsed, requests / lookups))
+    print()
+    print("%-8s %9s %9s %9s %9s %9s %9s %9s %11s" % (
+        "source", "requests", "per-look", "retries", "failures",
+        "mean ms", "p50 ms", "p95 ms", "bytes"))
+    for source, s in sorted(server_stats.items()):
+        trace = stats.get(source, {})
+        print("%-8s %9d %9.2f %9d %9d %9.1f %9.1f %9.1f %11d" % (
+            source, s["requests"], s["requests"] / lookups,
+            trace.get("retries", 0), trace.get("failures", 0),
+            1000 * trace.get("mean", 0.0),
+            1000 * trace.get("p50", 0.0),
+            1000 * trace.get("p95", 0.0),
+            trace.get("bytes", 0)))
+    print()
+    statuses = {}
+    for fetcher in fetchers:
+        statuses[fetcher.bib_status] = statuses.get(fetcher.bib_status, 0) + 1
+    print("bib_status counts:")
+    for status, count in sorted(statuses.items()):
+        print("    %r: %d" % (status, count))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of BibFetcher lookups.")
+    parser.add_argument("--lookups", type=int, default=100)
+    parser.add_argument("--engine", choices=["threaded", "async"],
+                        default="threaded")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", default="msn=0.3,zbmath=0.2,"
+                                             "arxiv=0.2,doi=0.1")
+    parser.add_argument("--failure", default="")
+    parser.add_argument("--miss", default="msn=0.2,zbmath=0.2,arxiv=0.3")
+    parser.add_argument("--doi-rate", type=float, default=0.3)
+    parser.add_argument("--arxiv-rate", type=float, default=0.2)
+    parser.add_argument("--page-size", type=int, default=30000)
+    parser.add_argument("--recordings", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = bib_stub_server.BibStubServer(
+        latency = bib_stub_server.parse_rates(args.latency),
+        failure = bib_stub_server.parse_rates(args.failure),
+        miss = bib_stub_server.parse_rates(args.miss),
+        page_size = args.page_size,
+        recordings = args.recordings,
+        seed = args.seed)
+    server.start()
+    point_fetchers_at(server.roots)
+    bib_fetcher.bib_stats.reset()
+
+    library = tempfile.mkdtemp(prefix="pulp-bench-")
+    bib_local.ZoteroIndex.default_db_path = os.path.join(
+        library, "no-zotero.sqlite")
+    try:
+        paths = make_library(library, args.lookups,
+                             args.doi_rate, args.arxiv_rate, args.seed)
+        start = time.perf_counter()
+        if args.engine == "async":
+            fetchers = run_async(paths, args.concurrency)
+        else:
+            fetchers = run_threaded(paths, args.concurrency)
+        elapsed = time.perf_counter() - start
+        with urllib.request.urlopen(server.base_url + "_stats") as handle:
+            server_stats = json.loads(handle.read().decode("utf-8"))
+        report(args.engine, args.concurrency, fetchers, elapsed,
+               bib_fetcher.bib_stats.summary(), server_stats)
+    finally:
+        server.stop()
+        shutil.rmtree(library, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
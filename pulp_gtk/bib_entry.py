@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import re
+import threading
+import time
+import unidecode
+
+############################################################
+# Entries
+############################################################
+
+class BibEntry:
+    """
+    One parsed bibtex entry. Field names are lower case and the values
+    are kept without their outer braces or quotes. provenance maps
+    every field to the source it was taken from.
+    """
+
+    def __init__(self, entry_type, key, fields=None, source=None):
+        self.entry_type = entry_type.lower()
+        self.key = key
+        self.fields = dict(fields or {})
+        self.source = source
+        self.provenance = dict.fromkeys(self.fields, source)
+        self.macros = set()
+        self.basename = None
+
+    def __repr__(self):
+        return "<BibEntry @{}{{{}}} from {}>".format(
+            self.entry_type, self.key, self.source)
+
+    def get(self, name, default=None):
+        return self.fields.get(name, default)
+
+    def to_bibtex(self):
+        bibtex = "@%s{%s,\n" % (self.entry_type, self.key)
+        for name, val in self.fields.items():
+            if name in self.macros:
+                bibtex += "    %s = %s,\n" % (name, val)
+            else:
+                bibtex += "    %s = {%s},\n" % (name, val)
+        bibtex += "}\n"
+        return bibtex
+
+    ########################################################
+    # Identifiers
+    ########################################################
+
+    @property
+    def doi(self):
+        doi = self.fields.get("doi")
+        if not doi:
+            return None
+        doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:)", "", doi.strip(),
+                     flags=re.I)
+        return doi.lower() or None
+
+    @property
+    def mr_number(self):
+        m = re.match(r"^MR(\d+)$", self.key)
+        if m is None:
+            m = re.match(r"^\s*(?:MR)?\s*(\d+)", self.fields.get("mrnumber", ""))
+        if m is None:
+            return None
+        return str(int(m.group(1)))
+
+    @property
+    def arxiv_id(self):
+        eprint = None
+        if self.key.lower().startswith("arxiv:"):
+            eprint = self.key[len("arxiv:"):]
+        elif self.fields.get("archiveprefix", "").lower() == "arxiv":
+            eprint = self.fields.get("eprint")
+        if not eprint:
+            return None
+        eprint = re.sub(r"v\d+$", "", eprint.strip())
+        return eprint.lower() or None
+
+    @property
+    def identifiers(self):
+        """
+        The (kind, value) pairs under which the entry is indexed.
+        """
+        ids = [("key", self.key)]
+        for kind in "doi", "mr_number", "arxiv_id":
+            val = getattr(self, kind)
+            if val is not None:
+                ids.append((kind, val))
+        return ids
+
+    @property
+    def title_key(self):
+        title = self.fields.get("title", "")
+        title = re.sub(r"\\[a-zA-Z]+|[{}$\\]", "", title)
+        title = unidecode.unidecode(title).lower()
+        return " ".join(re.findall(r"[a-z0-9]+", title))
+
+############################################################
+# Parser
+############################################################
+
+re_entry_start = re.compile(r"@\s*(\w+)\s*([{(])")
+re_field_name = re.compile(r"\s*([\w:.+/-]+)\s*=\s*")
+re_bare_value = re.compile(r"[\w:.+/-]+")
+
+# Entries are labelled by their key when a file mixes several sources
+key_sources = [
+    (re.compile(r"^MR\d+$"), "msn"),
+    (re.compile(r"^zbMATH", re.I), "zbmath"),
+    (re.compile(r"^arXiv:", re.I), "arxiv"),
+    (re.compile(r"^zotero:"), "zotero"),
+]
+
+# Entries whose key does not tell their source (DOI content negotiation,
+# BIBTEX64 trailers) are preceded by a "% pulp-source: <source>" line
+re_source_marker = re.compile(r"^%\s*pulp-source:\s*(\w+)", re.M)
+
+def source_marker(source):
+    return "% pulp-source: {}\n".format(source)
+
+def source_of_key(key, default=None):
+    for rgx, source in key_sources:
+        if rgx.match(key):
+            return source
+    return default
+
+def parse_bibtex(text, source=None):
+    """
+    Parse every entry of text. @comment, @string and @preamble blocks
+    and anything that is not an entry (amsrefs, % comments) are
+    skipped. When source is None, the source of each entry is guessed
+    from its key, or else taken from the last pulp-source marker.
+    """
+    entries = []
+    markers = [(m.start(), m.group(1))
+               for m in re_source_marker.finditer(text)]
+    pos = 0
+    while True:
+        m = re_entry_start.search(text, pos)
+        if m is None:
+            break
+        entry_type = m.group(1)
+        closing = "}" if m.group(2) == "{" else ")"
+        if entry_type.lower() in ("comment", "string", "preamble"):
+            pos = skip_group(text, m.end() - 1)
+            continue
+        entry, pos = parse_entry_body(text, m.end(), entry_type, closing)
+        if entry is None:
+            continue
+        marked = "unknown"
+        for marker_pos, marker_source in markers:
+            if marker_pos > m.start():
+                break
+            marked = marker_source
+        entry.source = source or source_of_key(entry.key, marked)
+        entry.provenance = dict.fromkeys(entry.fields, entry.source)
+        entries.append(entry)
+    return entries
+
+def parse_entry_body(text, pos, entry_type, closing):
+    end = text.find(",", pos)
+    brace = text.find(closing, pos)
+    if end < 0 or (0 <= brace < end):
+        return None, pos
+    key = text[pos:end].strip()
+    if not key or "\n\n" in key:
+        return None, pos
+    entry = BibEntry(entry_type, key)
+    pos = end + 1
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == closing:
+            return entry, pos + 1
+        m = re_field_name.match(text, pos)
+        if m is None:
+            return None, pos
+        name = m.group(1).lower()
+        val, bare, pos = parse_value(text, m.end())
+        if val is None:
+            return None, pos
+        entry.fields.setdefault(name, val)
+        if bare and not val.isdigit():
+            entry.macros.add(name)
+
+def parse_value(text, pos):
+    """
+    Parse a field value, possibly a concatenation with #, and return
+    (value, bare, new position). bare is True when the value is a
+    single macro name or number.
+    """
+    parts = []
+    bare = True
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n":
+            pos += 1
+        if pos >= len(text):
+            return None, False, pos
+        if text[pos] == "{":
+            end = skip_group(text, pos)
+            parts.append(text[pos+1:end-1])
+            bare = False
+        elif text[pos] == '"':
+            end = pos + 1
+            depth = 0
+            while end < len(text):
+                c = text[end]
+                if c == "{":
+                    depth += 1
+                elif c == "}":
+                    depth -= 1
+                elif c == '"' and depth == 0 and text[end-1] != "\\":
+                    break
+                end += 1
+            parts.append(text[pos+1:end])
+            end += 1
+            bare = False
+        else:
+            m = re_bare_value.match(text, pos)
+            if m is None:
+                return None, False, pos
+            parts.append(m.group(0))
+            end = m.end()
+        pos = end
+        while pos < len(text) and text[pos] in " \t\r\n":
+            pos += 1
+        if pos < len(text) and text[pos] == "#":
+            pos += 1
+            bare = False
+            continue
+        val = " ".join("".join(parts).split())
+        return val, bare and len(parts) == 1, pos
+
+def skip_group(text, pos):
+    """
+    Return the position after the group opened at pos.
+    """
+    opening = text[pos]
+    closing = "}" if opening == "{" else ")"
+    depth = 0
+    for n in range(pos, len(text)):
+        c = text[n]
+        if c == opening:
+            depth += 1
+        elif c == closing:
+            depth -= 1
+            if depth == 0:
+                return n + 1
+    return len(text)
+
+############################################################
+# Merging the sources of one document
+############################################################
+
+# Earlier sources win when two sources disagree on a field
+source_priority = ["personal", "bibtex64", "zotero", "doi",
+                   "msn", "zbmath", "arxiv", "unknown"]
+
+def source_rank(source):
+    try:
+        return source_priority.index(source)
+    except ValueError:
+        return len(source_priority)
+
+def same_work(entry, other):
+    for kind in "doi", "mr_number", "arxiv_id":
+        val = getattr(entry, kind)
+        if val is not None and val == getattr(other, kind):
+            return True
+    title = entry.title_key
+    return bool(title) and title == other.title_key
+
+def merge_entries(entries):
+    """
+    Group the entries that describe the same work (a common DOI, MR
+    number, arXiv id or title) and merge every group into one entry.
+    The merged entries are returned best source first; the fields of a
+    merged entry come from the best source that has them.
+    """
+    entries = sorted(entries, key=lambda e: source_rank(e.source))
+    groups = []
+    for entry in entries:
+        for group in groups:
+            if any(same_work(entry, other) for other in group):
+                group.append(entry)
+                break
+        else:
+            groups.append([entry])
+    return [merge_group(group) for group in groups]
+
+def merge_group(group):
+    best = group[0]
+    merged = BibEntry(best.entry_type, best.key, source=best.source)
+    merged.sources = group
+    for entry in group:
+        for name, val in entry.fields.items():
+            if name in merged.fields:
+                continue
+            merged.fields[name] = val
+            merged.provenance[name] = entry.provenance.get(name, entry.source)
+            if name in entry.macros:
+                merged.macros.add(name)
+    # Identifiers that are only implied by the key of another source
+    if "mrnumber" not in merged.fields:
+        for entry in group:
+            if entry.mr_number is not None:
+                merged.fields["mrnumber"] = entry.mr_number
+                merged.provenance["mrnumber"] = entry.source
+                break
+    if merged.arxiv_id is None:
+        for entry in group:
+            if entry.arxiv_id is not None:
+                merged.fields["archiveprefix"] = "arXiv"
+                merged.fields["eprint"] = entry.arxiv_id
+                merged.provenance["archiveprefix"] = entry.source
+                merged.provenance["eprint"] = entry.source
+                break
+    return merged
+
+############################################################
+# Index of the whole library
+############################################################
+
+class BibRecord:
+    """
+    The entries stored for one document: its cache file and its
+    personal file, merged.
+    """
+
+    def __init__(self, basename):
+        self.basename = basename
+        self.stamps = {}
+        self.entries = []
+
+    @property
+    def entry(self):
+        return self.entries[0] if self.entries else None
+
+    @property
+    def bibtex(self):
+        return "".join(entry.to_bibtex() for entry in self.entries)
+
+class BibIndex:
+    """
+    Index of the entries in ~/.pulp-bib/cache and ~/.pulp-bib/personal
+    by citation key, DOI, MR number and arXiv id. refresh() only
+    reparses the files whose mtime or size changed.
+    """
+
+    instance = None
+    lock = threading.Lock()
+
+    bib_dir = os.path.join(os.path.expanduser("~"), ".pulp-bib")
+    cache_dir = os.path.join(bib_dir, "cache")
+    personal_dir = os.path.join(bib_dir, "personal")
+
+    min_refresh_interval = 2.0
+
+    @classmethod
+    def get(cls, refresh=True):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            index = cls.instance
+        if refresh:
+            index.refresh()
+        return index
+
+    @classmethod
+    def notify(cls, path):
+        """
+        Tell the index that the bib file at path was written.
+        """
+        index = cls.instance
+        if index is not None:
+            index.update(os.path.splitext(os.path.basename(path))[0])
+
+    def __init__(self):
+        self.records = {}
+        self.ids = {}
+        self.id_entries = {}
+        self.record_ids = {}
+        self.last_refresh = None
+        self.mutex = threading.RLock()
+
+    def dirs(self):
+        return [("cache", self.cache_dir), ("personal", self.personal_dir)]
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if (not force and self.last_refresh is not None
+                and now - self.last_refresh < self.min_refresh_interval):
+            return
+        seen = self.scan()
+        with self.mutex:
+            for basename in list(self.records):
+                if basename not in seen:
+                    self.remove(basename)
+            for basename, stamps in seen.items():
+                record = self.records.get(basename)
+                if record is None or record.stamps != stamps:
+                    self.load(basename, stamps)
+            self.last_refresh = now
+
+    def scan(self):
+        """
+        Return {basename: {"cache": stamp, "personal": stamp}} where a
+        stamp is the (mtime, size) of the file. Nothing is read.
+        """
+        seen = {}
+        for kind, directory in self.dirs():
+            try:
+                with os.scandir(directory) as it:
+                    for dentry in it:
+                        if not dentry.name.endswith(".bib"):
+                            continue
+                        try:
+                            st = dentry.stat()
+                        except OSError:
+                            continue
+                        basename = dentry.name[:-len(".bib")]
+                        seen.setdefault(basename, {})[kind] = (
+                            st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        return seen
+
+    def update(self, basename):
+        stamps = {}
+        for kind, directory in self.dirs():
+            try:
+                st = os.stat(os.path.join(directory, basename + ".bib"))
+            except OSError:
+                continue
+            stamps[kind] = (st.st_mtime_ns, st.st_size)
+        with self.mutex:
+            if stamps:
+                self.load(basename, stamps)
+            else:
+                self.remove(basename)
+
+    def load(self, basename, stamps):
+        entries = []
+        for kind, directory in self.dirs():
+            if kind not in stamps:
+                continue
+            path = os.path.join(directory, basename + ".bib")
+            try:
+                with open(path, encoding="utf-8") as bib_file:
+                    text = bib_file.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            source = "personal" if kind == "personal" else None
+            entries += parse_bibtex(text, source)
+        record = BibRecord(basename)
+        record.stamps = stamps
+        record.entries = merge_entries(entries)
+        for entry in record.entries:
+            entry.basename = basename
+        self.remove(basename)
+        self.records[basename] = record
+        ids = set()
+        for entry in record.entries:
+            entry_ids = set(entry.identifiers)
+            for source_entry in getattr(entry, "sources", [entry]):
+                entry_ids.update(source_entry.identifiers)
+            for ident in entry_ids:
+                self.id_entries.setdefault(ident, []).append(entry)
+                self.ids.setdefault(ident, entry)
+            ids |= entry_ids
+        self.record_ids[basename] = ids
+
+    def remove(self, basename):
+        record = self.records.pop(basename, None)
+        if record is None:
+            return
+        for ident in self.record_ids.pop(basename, ()):
+            # Another record may carry the same DOI or arXiv id
+            entries = [entry for entry in self.id_entries.get(ident, ())
+                       if entry.basename != basename]
+            if entries:
+                self.id_entries[ident] = entries
+                self.ids[ident] = entries[0]
+            else:
+                self.id_entries.pop(ident, None)
+                self.ids.pop(ident, None)
+
+    ########################################################
+    # Lookups
+    ########################################################
+
+    def by_basename(self, basename):
+        return self.records.get(basename)
+
+    def by_key(self, key):
+        return self.ids.get(("key", key))
+
+    def by_doi(self, doi):
+        return self.ids.get(("doi", BibEntry("misc", "", {"doi": doi}).doi))
+
+    def by_mr_number(self, mr_number):
+        m = re.search(r"\d+", str(mr_number))
+        return self.ids.get(("mr_number", str(int(m.group(0))))) if m else None
+
+    def by_arxiv_id(self, arxiv_id):
+        arxiv_id = re.sub(r"v\d+$", "", arxiv_id.strip()).lower()
+        return self.ids.get(("arxiv_id", arxiv_id))
+
+    def lookup(self, ident):
+        """
+        Find an entry by any identifier: a citation key, a DOI, an MR
+        number ("MR1234567") or an arXiv id.
+        """
+        ident = ident.strip()
+        entry = self.by_key(ident)
+        if entry is None and ident.startswith("10."):
+            entry = self.by_doi(ident)
+        if entry is None and re.match(r"^MR\s*\d+$", ident):
+            entry = self.by_mr_number(ident)
+        if entry is None:
+            entry = self.by_arxiv_id(re.sub(r"^arxiv:", "", ident, flags=re.I))
+        return entry
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Maintained export of the whole library to one master .bib file.
+
+Every document gets a block in the master file that starts with a
+
+    % pulp-bib: <basename>
+
+line. A state file next to the master remembers the mtime and size of
+the cache and personal files each block was made from; an update only
+regenerates the blocks whose sources changed and splices them into the
+existing text, and the master file is replaced atomically.
+
+    python3 -m pulp_gtk.bib_export ~/library.bib
+"""
+
+import argparse
+import json
+import os
+import os.path
+import re
+import tempfile
+import time
+
+from . import bib_entry
+
+re_block = re.compile(r"^% pulp-bib: (.*)$", re.M)
+
+def write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(text)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class BibExport:
+
+    def __init__(self, master_path, index=None):
+        self.master_path = master_path
+        self.state_path = master_path + ".state.json"
+        self.index = index
+
+    ########################################################
+    # Master file and state
+    ########################################################
+
+    def read_blocks(self):
+        """
+        Split the master file into {basename: block text}. Text before
+        the first block (a header written by hand) is kept under None.
+        """
+        try:
+            with open(self.master_path, encoding="utf-8") as master_file:
+                text = master_file.read()
+        except (OSError, UnicodeDecodeError):
+            return {}
+        blocks = {}
+        matches = list(re_block.finditer(text))
+        if not matches:
+            blocks[None] = text
+            return blocks
+        if matches[0].start() > 0:
+            blocks[None] = text[:matches[0].start()]
+        for m, next_m in zip(matches, matches[1:] + [None]):
+            end = next_m.start() if next_m is not None else len(text)
+            blocks[m.group(1)] = text[m.start():end]
+        return blocks
+
+    def read_state(self):
+        """
+        Return the stamps of the sources of every document and the set
+        of documents that had no entry, as of the last update.
+        """
+        try:
+            with open(self.state_path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return {}, set()
+        if state.get("master") != self.master_stamp():
+            # The master file was changed behind our back
+            return {}, set()
+        stamps = {basename: {kind: tuple(stamp)
+                             for kind, stamp in source_stamps.items()}
+                  for basename, source_stamps in state.get("stamps", {}).items()}
+        return stamps, set(state.get("empty", []))
+
+    def write_state(self, stamps, empty):
+        state = dict(master=self.master_stamp(), stamps=stamps,
+                     empty=sorted(empty))
+        write_atomic(self.state_path, json.dumps(state))
+
+    def master_stamp(self):
+        try:
+            st = os.stat(self.master_path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    ########################################################
+    # Update
+    ########################################################
+
+    def render(self, record):
+        return "% pulp-bib: {}\n{}\n".format(record.basename, record.bibtex)
+
+    def update(self):
+        """
+        Bring the master file up to date. Return a dict with the number
+        of added, changed, removed and kept blocks.
+        """
+        index = self.index or bib_entry.BibIndex()
+        old_stamps, old_empty = self.read_state()
+        blocks = self.read_blocks()
+        if not old_stamps:
+            # Without a valid state every block is regenerated
+            blocks = {None: blocks[None]} if None in blocks else {}
+        counts = dict(added=0, changed=0, removed=0, kept=0)
+
+        stamps = {}
+        empty = set()
+        for basename, source_stamps in index.scan().items():
+            if (old_stamps.get(basename) == source_stamps
+                    and (basename in blocks or basename in old_empty)):
+                stamps[basename] = source_stamps
+                if basename in old_empty:
+                    empty.add(basename)
+                else:
+                    counts["kept"] += 1
+                continue
+            # Only the documents whose sources changed are parsed
+            index.update(basename)
+            record = index.by_basename(basename)
+            if record is None:
+                continue
+            stamps[basename] = record.stamps
+            if not record.entries:
+                # A "% No MathSciNet entry found." placeholder: no block,
+                # but its stamp is kept so that it is not parsed again
+                empty.add(basename)
+                continue
+            counts["changed" if basename in blocks else "added"] += 1
+            blocks[basename] = self.render(record)
+        for basename in list(blocks):
+            if basename is not None and (basename not in stamps
+                                         or basename in empty):
+                del blocks[basename]
+                counts["removed"] += 1
+
+        if counts["added"] or counts["changed"] or counts["removed"] \
+                or not os.path.exists(self.master_path):
+            text = blocks.pop(None, "")
+            text += "".join(blocks[basename] for basename in sorted(blocks))
+            write_atomic(self.master_path, text)
+            self.write_state(stamps, empty)
+        elif stamps != old_stamps or empty != old_empty:
+            self.write_state(stamps, empty)
+        return counts
+
+############################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update the master .bib file of the library.")
+    parser.add_argument("master")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = BibExport(os.path.expanduser(args.master)).update()
+    print("added: {added}   changed: {changed}   removed: {removed}   "
+          "kept: {kept}".format(**counts))
+    print("elapsed: %.2f s" % (time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
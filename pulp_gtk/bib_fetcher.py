@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
 
 import base64
+import codecs
 import collections
 import concurrent.futures
 import functools
 import gi
 import glob
-import html.entities
+import json
 import os
 import os.path
 import re
 import subprocess
 import sys
 import threading
+import time
 import unidecode
 import urllib.error
 import urllib.parse
 import urllib.request
+import xml.etree.ElementTree
 
 from gi.repository import GLib
 
+from . import bib_entry
+from . import bib_local
+
 ############################################################
 
 def memoized_property(fget):
@@ -35,26 +41,186 @@ def memoized_property(fget):
 
 ############################################################
 
-def unescape(text):
-    def fixup(m):
-        text = m.group(0)
-        if text[:2] == "&#":
-            # character reference
-            try:
-                if text[:3] == "&#x":
-                    return chr(int(text[3:-1], 16))
-                else:
-                    return chr(int(text[2:-1]))
-            except ValueError:
-                pass
-        else:
-            # named entity
-            try:
-                text = chr(html.entities.name2codepoint[text[1:-1]])
-            except KeyError:
-                pass
-        return text # leave as is
-    return re.sub("&#?\w+;", fixup, text)
+def config(name, default):
+    """
+    Service roots and proxy settings, overridable with PULP_<name>
+    environment variables (e.g. to point at bib_stub_server).
+    """
+    return os.environ.get("PULP_" + name, default)
+
+############################################################
+
+name_particles = {"da", "de", "del", "della", "der", "di", "dos", "du",
+                  "la", "le", "ten", "ter", "van", "von"}
+name_suffixes = {"jr", "jr.", "sr", "sr.", "ii", "iii", "iv"}
+
+def arxiv_author_name(name):
+    """
+    An arXiv author name as "Last, First" (or "Last, Jr., First"), the
+    way the abs page gave it. The last name starts at the first
+    lowercase particle ("B. L. van der Waerden" gives "van der
+    Waerden, B. L."), or else is the last word.
+    """
+    words = name.split()
+    if len(words) < 2 or "," in name:
+        return " ".join(words)
+    suffix = None
+    if words[-1].lower() in name_suffixes:
+        suffix = words.pop()
+        if len(words) < 2:
+            return " ".join(words + [suffix])
+    start = next((n for n, word in enumerate(words[1:-1], 1)
+                  if word.islower() and word in name_particles),
+                 len(words) - 1)
+    last = " ".join(words[start:]) + (", " + suffix if suffix else "")
+    return last + ", " + " ".join(words[:start])
+
+def parse_arxiv_atom(atom):
+    """
+    Parse an arXiv API Atom feed into one dictionary per entry, with
+    the same keys the arXiv abs page exposes as citation_* meta tags.
+    """
+    if "</feed>" not in atom:
+        # Feed cut short by an early stop of the download
+        end = atom.rfind("</entry>")
+        if end >= 0:
+            atom = atom[:end + len("</entry>")] + "</feed>"
+    try:
+        feed = xml.etree.ElementTree.fromstring(atom)
+    except xml.etree.ElementTree.ParseError:
+        return []
+    ns = {"atom": "http://www.w3.org/2005/Atom",
+          "arxiv": "http://arxiv.org/schemas/atom"}
+    entries = []
+    for entry in feed.findall("atom:entry", ns):
+        data = {}
+        m = re.search(r"arxiv\.org/abs/(.+?)(v\d+)?$",
+                      entry.findtext("atom:id", "", ns).strip())
+        if not m:
+            continue
+        authors = []
+        for name in entry.findall("atom:author/atom:name", ns):
+            name = arxiv_author_name(name.text or "")
+            if name:
+                authors.append(name)
+        if authors:
+            data["author"] = " and ".join(authors)
+        title = entry.findtext("atom:title", "", ns)
+        if title.strip():
+            data["title"] = " ".join(title.split())
+        published = entry.findtext("atom:published", "", ns)
+        if published:
+            data["date"] = published[:10].replace("-", "/")
+        data["archivePrefix"] = "arXiv"
+        data["eprint"] = m.group(1)
+        for link in entry.findall("atom:link", ns):
+            if link.get("title") == "pdf":
+                data["pdf_url"] = link.get("href")
+                data["url"] = data["pdf_url"].replace("pdf", "abs", 1)
+        doi = entry.findtext("arxiv:doi", "", ns)
+        if doi.strip():
+            data["doi"] = doi.strip()
+        entries.append(data)
+    return entries
+
+############################################################
+# Early stop of a download
+############################################################
+
+class MarkerScanner:
+    """
+    An until test of get_html: feed() is given each decoded chunk of a
+    response and is true once pattern has arrived. Only the chunk and
+    the last overlap characters before it are searched, so a long page
+    is scanned once.
+    """
+
+    overlap = 64
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.tail = ""
+
+    def feed(self, chunk):
+        window = self.tail + chunk
+        if self.pattern.search(window):
+            return True
+        self.tail = window[-self.overlap:]
+        return False
+
+class AtomEntryScanner:
+    """
+    An until test of get_html for an Atom feed: true once an entry for
+    which test(entry_text) is true has arrived. Only the entry still
+    arriving is kept between chunks.
+    """
+
+    rgx_entry = re.compile(r"<entry>.*?</entry>", re.S)
+
+    def __init__(self, test):
+        self.test = test
+        self.pending = ""
+
+    def feed(self, chunk):
+        text = self.pending + chunk
+        end = 0
+        for m in self.rgx_entry.finditer(text):
+            if self.test(m.group(0)):
+                return True
+            end = m.end()
+        start = text.find("<entry>", end)
+        if start < 0:
+            start = max(end, len(text) - len("<entry>"))
+        self.pending = text[start:]
+        return False
+
+############################################################
+
+class FetchCancelled(Exception):
+    pass
+
+class CancelToken:
+    """
+    Shared flag telling a lookup to stop. BibFetcher checks it before
+    every request; callbacks registered with on_cancel run (in the
+    cancelling thread) when it is set.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def check(self):
+        if self.event.is_set():
+            raise FetchCancelled()
+
+    def child(self):
+        """
+        A token that can be cancelled on its own, and is cancelled with
+        this one.
+        """
+        token = CancelToken()
+        self.on_cancel(token.cancel)
+        return token
 
 ############################################################
 
@@ -64,10 +230,13 @@ class BibFetcher:
     # Guess data for one file
     ########################################################
 
-    def __init__(self, path):
+    def __init__(self, path, cancel_token=None):
         self.original_path = path
         self.path = path
         self.filename = os.path.basename(self.path)
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        self.cancel_token = cancel_token
 
     rgx = re.compile(r"""
                      ^
@@ -168,29 +337,139 @@ class BibFetcher:
 
     @memoized_property
     def bibtex(self):
-        if not self.is_good:
-            bib = [self.bibtex_head,
-                   self.msn_not_found,
-                   self.zbmath_not_found,
-                   self.arxiv_not_found]
+        self.cancel_token.check()
+        if self.local_bib:
+            bib = [self.bibtex_head, self.local_bib]
         else:
-            bib = [self.bibtex_head,
-                   self.msn_bib,
-                   self.zbmath_bib,
-                   self.arxiv_bib]
+            bib = [self.bibtex_head] + self.remote_bibs
         return "\n".join(bib)
 
+    @property
+    def remote_bibs(self):
+        if self.doi_bib:
+            bib = [self.doi_bib]
+        elif not self.is_good:
+            bib = [self.msn_not_found,
+                   self.zbmath_not_found]
+        else:
+            bib = [self.msn_bib,
+                   self.zbmath_bib]
+        if not self.is_good:
+            bib += [self.arxiv_not_found]
+        else:
+            bib += [self.arxiv_bib]
+        return bib
+
+    @memoized_property
+    def bib_entries(self):
+        """
+        The entries of bibtex, one merged entry per work, best first.
+        """
+        return bib_entry.merge_entries(bib_entry.parse_bibtex(self.bibtex))
+
     @memoized_property
     def bibtex_head(self):
         return "% {}\n".format(self.filename)
 
     @property
     def bib_status(self):
-        return (self.msn_status 
+        return (self.local_status
+                + self.doi_status
+                + self.msn_status 
                 + self.zbmath_status 
                 + self.arxiv_status
                 + self.per_status)
 
+    ########################################################
+    # Local bibtex: BIBTEX64 trailer and Zotero database
+    ########################################################
+
+    local_status = " "
+
+    @memoized_property
+    def local_bib(self):
+        bibs = [self.bibtex64_bib, self.zotero_bib]
+        bibs = [bib.strip() + "\n" for bib in bibs if bib]
+        self.local_status = "L" if bibs else "-"
+        return "\n".join(bibs)
+
+    @memoized_property
+    def bibtex64_bib(self):
+        bib = bib_local.read_bibtex64_trailer(self.original_path)
+        self.trace_cache("bibtex64", bib is not None)
+        if bib:
+            bib = bib_entry.source_marker("bibtex64") + bib
+        return bib
+
+    @memoized_property
+    def zotero_bib(self):
+        index = bib_local.ZoteroIndex.get()
+        if index is None:
+            return None
+        bib = index.lookup(self.original_path)
+        self.trace_cache("zotero", bib is not None)
+        return bib
+
+    ########################################################
+    # Identifiers embedded in the file
+    ########################################################
+
+    @memoized_property
+    def pdf_ids(self):
+        with open(self.original_path, "r", encoding="latin-1") as pdffile:
+            pdfdata = pdffile.read()
+        ids = {}
+        m = re.search(r"/URI\(http://ar[Xx]iv.org/abs/(.+)\)", pdfdata)
+        if m:
+            ids["arxiv_id"] = m.group(1)
+        # Only the document metadata (XMP packet or Info dictionary) is
+        # trusted for the DOI; link annotations usually point to the
+        # references.
+        m = self.doi_rgx_pdf.search(pdfdata)
+        if m:
+            ids["doi"] = next(doi for doi in m.groups() if doi)
+        return ids
+
+    doi_rgx_pdf = re.compile(r"""
+                             <(?:prism|pdfx|crossmark):(?:doi|DOI)>
+                             \s* (?:doi:)? (10\.\d{4,9}/[^<\s]+) \s*
+                             </
+                             |
+                             /(?:doi|DOI) \s* \( (?:doi:)? (10\.\d{4,9}/[^)\s]+) \)
+                             """, re.X)
+
+    ########################################################
+    # Fetch bibtex through the DOI
+    ########################################################
+
+    doi_status = " "
+    doi_root = config("DOI_ROOT", "https://doi.org/")
+    doi_headers = {"Accept": "application/x-bibtex; charset=utf-8"}
+
+    @memoized_property
+    def doi_from_pdf(self):
+        return self.pdf_ids.get("doi")
+
+    @memoized_property
+    def doi_bib(self):
+        if self.doi_from_pdf is None:
+            return ""
+        bib = self.get_html(self.doi_url, headers=self.doi_headers,
+                            source="doi")
+        return self.doi_bib_result(bib)
+
+    @memoized_property
+    def doi_url(self):
+        return self.doi_root + urllib.parse.quote(self.doi_from_pdf)
+
+    def doi_bib_result(self, bib):
+        if bib and bib.lstrip().startswith("@"):
+            self.doi_status = "D"
+            return bib_entry.source_marker("doi") + bib.strip() + "\n"
+        else:
+            self.doi_status = "-"
+            return ""
+
     ########################################################
     # Fetch MathSciNet bibtex
     ########################################################
@@ -200,13 +479,19 @@ class BibFetcher:
 
     @memoized_property
     def msn_bib(self):
-        bibs = self.msn_bib_bibtex(True)
+        use_year = True
+        bibs = self.msn_bib_aux(self.msn_url("bibtex", use_year),
+                                self.msn_rgx_bibtex)
+        if not bibs and self.year is not None:
+            use_year = False
+            bibs = self.msn_bib_aux(self.msn_url("bibtex", use_year),
+                                    self.msn_rgx_bibtex)
         if bibs:
-            bibs += self.msn_bib_amsrefs(True)
-        elif self.year is not None:
-            bibs = self.msn_bib_bibtex(False)
-            if bibs:
-                bibs += self.msn_bib_amsrefs(False)
+            bibs += self.msn_bib_aux(self.msn_amsrefs_url(bibs, use_year),
+                                     self.msn_rgx_amsrefs)
+        return self.msn_bib_result(bibs)
+
+    def msn_bib_result(self, bibs):
         if bibs:
             self.msn_status = "M"
             bib = "\n".join(bibs)
@@ -222,16 +507,20 @@ class BibFetcher:
 
     msn_rgx_bibtex = re.compile(r"^@.*?^}", re.M | re.S)
     msn_rgx_amsrefs = re.compile(r"^\\bib.*?^}", re.M | re.S)
+    msn_rgx_mr_number = re.compile(r"^@\w+\s*{MR(\d+),", re.M)
+
+    def msn_bib_aux(self, url, regex):
+        html = self.get_html(url, use_proxy=True, source="msn",
+                             until=self.msn_page_done)
+        return self.msn_bib_extract(html, regex)
 
-    def msn_bib_bibtex(self, use_year):
-        return self.msn_bib_aux("bibtex", self.msn_rgx_bibtex, use_year)
+    # Everything after the result list is page chrome
+    msn_rgx_end = re.compile(r'<div\s+(?:id|class)="footer"', re.I)
 
-    def msn_bib_amsrefs(self, use_year):
-        return self.msn_bib_aux("amsrefs", self.msn_rgx_amsrefs, use_year)
+    def msn_page_done(self):
+        return MarkerScanner(self.msn_rgx_end)
 
-    def msn_bib_aux(self, fmt, regex, use_year):
-        url = self.msn_url(fmt, use_year)
-        html = self.get_html(url, use_proxy=True)
+    def msn_bib_extract(self, html, regex):
         if not html:
             return []
         bibs = re.findall(regex, html)
@@ -240,13 +529,32 @@ class BibFetcher:
         else:
             return []
 
-    msn_root = "http://www.ams.org/mathscinet/search/publications.html?fmt="
+    msn_root = config(
+        "MSN_ROOT", "http://www.ams.org/mathscinet/search/publications.html")
 
     def msn_url(self, fmt, use_year=True):
         if use_year:
-            return self.msn_root + fmt + self.msn_query_year
+            return self.msn_root + "?fmt=" + fmt + self.msn_query_year
         else:
-            return self.msn_root + fmt + self.msn_query
+            return self.msn_root + "?fmt=" + fmt + self.msn_query
+
+    def msn_mr_numbers(self, bibs):
+        mr_numbers = []
+        for bib in bibs:
+            m = self.msn_rgx_mr_number.search(bib)
+            if m and m.group(1) not in mr_numbers:
+                mr_numbers.append(m.group(1))
+        return mr_numbers
+
+    def msn_amsrefs_url(self, bibs, use_year):
+        # The MR numbers of the bibtex search results identify the
+        # papers, so the amsrefs entries come from a single MR lookup
+        # instead of repeating the title/author search.
+        mr_numbers = self.msn_mr_numbers(bibs)
+        if not mr_numbers:
+            return self.msn_url("amsrefs", use_year)
+        query = urllib.parse.quote(" or ".join(mr_numbers))
+        return self.msn_root + "?fmt=amsrefs&pg1=MR&s1=" + query
 
     @memoized_property
     def msn_query(self):
@@ -279,29 +587,63 @@ class BibFetcher:
 
     @memoized_property
     def zbmath_bib(self):
-        html = self.get_html(self.zbmath_url_year)
-        if not html:
-            self.zbmath_status = "-"
-            return self.zbmath_not_found
-        m = re.search(r"bibtex/(\d|\.)+\.bib", html)
-        if not m:
-            html = self.get_html(self.zbmath_url)
-            if not html:
-                self.zbmath_status = "-"
-                return self.zbmath_not_found
-            m = re.search(r"bibtex/(\d|\.)+\.bib", html)
-        if not m:
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.zbmath_max_entries)
+        # Stops the search that lost the race
+        search_token = self.cancel_token.child()
+        try:
+            futures = [pool.submit(self.zbmath_search, url, search_token)
+                       for url in self.zbmath_search_urls]
+            bib_urls = []
+            for future in concurrent.futures.as_completed(futures):
+                bib_urls = future.result()
+                if bib_urls:
+                    break
+            search_token.cancel()
+            bibs = list(pool.map(
+                functools.partial(self.get_html, source="zbmath"),
+                bib_urls))
+        finally:
+            search_token.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return self.zbmath_bib_result(bibs)
+
+    def zbmath_bib_result(self, bibs):
+        bibs = [bib + "\n" for bib in bibs if bib]
+        if bibs:
+            self.zbmath_status = "Z"
+            return "\n".join(bibs)
+        else:
             self.zbmath_status = "-"
             return self.zbmath_not_found
-        else:
-            bib_url = "https://zbmath.org/" + m.group(0)
-            bib = self.get_html(bib_url)
-            if bib:
-                self.zbmath_status = "Z"
-                return bib + "\n"
-            else:
-                self.zbmath_status = "-"
-                return self.zbmath_not_found
+
+    def zbmath_search(self, url, cancel_token=None):
+        html = self.get_html(url, source="zbmath", cancel_token=cancel_token)
+        return self.zbmath_bib_urls(html)
+
+    def zbmath_bib_urls(self, html):
+        bib_urls = []
+        if not html:
+            return bib_urls
+        for m in self.zbmath_rgx_bib.finditer(html):
+            bib_url = self.zbmath_root + m.group(0)
+            if bib_url not in bib_urls:
+                bib_urls.append(bib_url)
+        return bib_urls[:self.zbmath_max_entries]
+
+    zbmath_rgx_bib = re.compile(r"bibtex/(\d|\.)+\.bib")
+    zbmath_max_entries = 5
+
+    zbmath_root = config("ZBMATH_ROOT", "https://zbmath.org/")
+
+    @memoized_property
+    def zbmath_search_urls(self):
+        # The searches with and without the year are sent together and
+        # the first one that finds an entry wins.
+        urls = [self.zbmath_url_year]
+        if self.zbmath_url not in urls:
+            urls.append(self.zbmath_url)
+        return urls
 
     @memoized_property
     def zbmath_url_year(self):
@@ -313,7 +655,7 @@ class BibFetcher:
             url.append(tmpl(key='py', val=self.year))
         url.append(tmpl(key='au', val=self.zbmath_author_aux))
         url = " %26 ".join(url)
-        url = "https://zbmath.org/?q=" + url
+        url = self.zbmath_root + "?q=" + url
         return url
 
     @memoized_property
@@ -324,7 +666,7 @@ class BibFetcher:
         url.append(tmpl(key='ti', val=title))
         url.append(tmpl(key='au', val=self.zbmath_author_aux))
         url = " %26 ".join(url)
-        url = "https://zbmath.org/?q=" + url
+        url = self.zbmath_root + "?q=" + url
         return url
 
     @memoized_property
@@ -363,27 +705,7 @@ class BibFetcher:
 
     @memoized_property
     def arxiv_id_from_pdf(self):
-        with open(self.path, "r", encoding="latin-1") as pdffile:
-            pdfdata = pdffile.read()
-        m = re.search(r"/URI\(http://ar[Xx]iv.org/abs/(.+)\)", pdfdata)
-        if not m:
-            return None
-        else:
-            return m.group(1)
-
-    arxiv_rgx = re.compile(r"""
-                           < (?P<type> id|title ) >
-                           (?:
-                               (?:
-                                   http://arxiv\.org/abs/
-                                   (?P<arxiv_id> .*? )
-                                   (?: v\d+ )?
-                               )
-                               |
-                               (?P<title> .*? )
-                           )
-                           </ (?P=type) >
-                           """, re.X)
+        return self.pdf_ids.get("arxiv_id")
 
     def title_match(self, other_title):
         ots = other_title.split()
@@ -393,16 +715,35 @@ class BibFetcher:
         return len(inter) >= goal
 
     def get_arxiv_id_from_web(self):
-        atom = self.get_html(self.arxiv_atom_url)
+        atom = self.get_html(self.arxiv_atom_url, source="arxiv",
+                             until=self.arxiv_search_done)
+        return self.arxiv_id_from_atom(atom)
+
+    # The search results already carry everything arxiv_data needs,
+    # so the matching entry is kept to save a second request.
+    arxiv_entry = None
+
+    def arxiv_id_from_atom(self, atom):
         if not atom:
             return None
-        arxiv_id = ""
-        for m in self.arxiv_rgx.finditer(atom):
-            md = m.groupdict()
-            if md['type'] == 'id':
-                arxiv_id = md['arxiv_id']
-            elif arxiv_id and self.title_match(md['title']):
-                return arxiv_id
+        for data in parse_arxiv_atom(atom):
+            if "title" in data and self.title_match(data["title"]):
+                self.arxiv_entry = data
+                return data["eprint"]
+
+    arxiv_rgx_title = re.compile(r"<title>(.*?)</title>", re.S)
+    arxiv_rgx_entry_end = re.compile(r"</entry>")
+
+    def arxiv_search_done(self):
+        # The download can stop at the first entry matching our title
+        return AtomEntryScanner(self.arxiv_entry_matches)
+
+    def arxiv_entry_matches(self, entry):
+        m = self.arxiv_rgx_title.search(entry)
+        return bool(m) and self.title_match(" ".join(m.group(1).split()))
+
+    def arxiv_entry_done(self):
+        return MarkerScanner(self.arxiv_rgx_entry_end)
 
     @memoized_property
     def arxiv_atom_url(self):
@@ -415,38 +756,32 @@ class BibFetcher:
             author = unidecode.unidecode(author)
             author = urllib.parse.quote(author)
             queries.append(tmpl(key='au', val=author))
-        root = "http://export.arxiv.org/api/query?search_query="
         query = "+AND+".join(queries)
-        return root + query
+        return self.arxiv_api_root + "?search_query=" + query
+
+    arxiv_api_root = config(
+        "ARXIV_API_ROOT", "http://export.arxiv.org/api/query")
 
     @memoized_property
     def arxiv_data(self):
         if self.arxiv_id is None:
             return {}
-        url = "http://arxiv.org/abs/" + self.arxiv_id
-        html = self.get_html(url)
-        regex = r"<meta\s*name=\"citation_(%s)\"\s*content=\"(.*)\"\s*/>"
-        regex = regex % "title|author|date|arxiv_id|pdf_url|doi"
-        data = {}
-        for line in html.split("\n"):
-            m = re.match(regex, line)
-            if m:
-                key = m.group(1)
-                content = m.group(2)
-                if key == "author" or key == "title":
-                    content = unescape(content)
-                if key == "author" and "author" in data:
-                    data["author"] += " and " + content
-                elif key == "arxiv_id":
-                    data["archivePrefix"] = "arXiv"
-                    data["eprint"] = content
-                elif key == "pdf_url":
-                    data["pdf_url"] = content
-                    content = content.replace("pdf", "abs", 1)
-                    data["url"] = content
-                else:
-                    data[key] = content
-        return data
+        if self.arxiv_entry is not None:
+            return self.arxiv_entry
+        atom = self.get_html(self.arxiv_id_url, source="arxiv",
+                             until=self.arxiv_entry_done)
+        return self.arxiv_data_from_atom(atom)
+
+    @memoized_property
+    def arxiv_id_url(self):
+        return self.arxiv_api_root + "?id_list=" + self.arxiv_id
+
+    def arxiv_data_from_atom(self, atom):
+        if not atom:
+            return {}
+        for data in parse_arxiv_atom(atom):
+            return data
+        return {}
 
     @memoized_property
     def arxiv_bib_aux(self):
@@ -492,6 +827,10 @@ class BibFetcher:
     # Personal bibtex entries
     ########################################################
 
+    @property
+    def per_status(self):
+        return "P" if self.personal_bib_exists else " "
+
     @memoized_property
     def personal_bib(self):
         if not self.personal_bib_exists:
@@ -517,6 +856,7 @@ class BibFetcher:
             pfile.write(pbib)
         self._personal_bib_exists = True
         self._personal_bib = pbib
+        bib_entry.BibIndex.notify(self.personal_bib_path)
 
     ########################################################
     # Cache of bibtex entries
@@ -525,7 +865,9 @@ class BibFetcher:
     @memoized_property
     def cache_bib(self):
         if not self.cache_bib_exists:
+            self.trace_cache("cache", False)
             return ""
+        self.trace_cache("cache", True)
         with open(self.cache_bib_path, encoding="utf-8") as cfile:
             return cfile.read()
 
@@ -549,35 +891,205 @@ class BibFetcher:
             cfile.write(bib)
         self._cache_bib_exists = True
         self._cache_bib = bib
+        bib_entry.BibIndex.notify(self.cache_bib_path)
+
+    ########################################################
+    # Lookup traces
+    ########################################################
+
+    @memoized_property
+    def trace(self):
+        return []
+
+    def trace_fetch(self, source, url, start, retries, status, nbytes):
+        self.add_trace(dict(
+            source = source, url = url,
+            duration = time.monotonic() - start,
+            retries = retries, status = status, bytes = nbytes))
+
+    def trace_cache(self, source, hit):
+        self.add_trace(dict(
+            source = source, cache = "hit" if hit else "miss"))
+
+    def add_trace(self, record):
+        record["file"] = os.path.basename(self.original_path)
+        record["time"] = time.time()
+        self.trace.append(record)
+        bib_stats.add(record)
 
     ########################################################
     # Url opener with proxy
     ########################################################
     
-    def get_html(self, url, use_proxy=False):
+    timeout = 60
+
+    def get_html(self, url, use_proxy=False, headers=None, source=None,
+                 until=None, cancel_token=None):
+        """
+        Fetch url, retrying up to ten times with timeout seconds for
+        each attempt. cancel_token (the one of the lookup by default)
+        is checked before each attempt and before the body is read.
+        """
+        if cancel_token is None:
+            cancel_token = self.cancel_token
         url = url.replace(' ', '%20')
-        req = urllib.request.Request(url)
+        req = urllib.request.Request(url, headers=headers or {})
         if use_proxy:
             self.add_proxy(req)
+        start = time.monotonic()
+        status = None
         for try_num in range(10):
+            cancel_token.check()
             try:
-                handle = urllib.request.urlopen(req)
+                handle = urllib.request.urlopen(req, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                handle = None
+                status = e.code
+                if e.code in self.fatal_http_codes:
+                    break
+                continue
             except:
                 handle = None
+                status = None
                 continue
             else:
+                status = handle.status
                 break
         if handle is None:
+            self.trace_fetch(source, url, start, try_num, status, 0)
             return
-        enc = handle.headers.get_content_charset()
-        html = handle.read()
-        html = html.decode(enc)
+        if cancel_token.cancelled:
+            handle.close()
+            cancel_token.check()
+        enc = handle.headers.get_content_charset() or "utf-8"
+        if until is None:
+            html = handle.read()
+            self.trace_fetch(source, url, start, try_num, status, len(html))
+            html = html.decode(enc)
+        else:
+            html, nbytes = self.read_until(handle, enc, until)
+            self.trace_fetch(source, url, start, try_num, status, nbytes)
         return html
 
+    # Retrying will not change these answers
+    fatal_http_codes = (400, 404, 406, 410)
+
+    read_chunk_size = 16384
+
+    def read_until(self, handle, enc, until):
+        """
+        Read the response in chunks and stop (closing the connection)
+        as soon as the scanner made by until() is fed the chunk it
+        waits for.
+        """
+        decoder = codecs.getincrementaldecoder(enc)(errors="replace")
+        scanner = until()
+        chunks = []
+        nbytes = 0
+        try:
+            while True:
+                data = handle.read(self.read_chunk_size)
+                nbytes += len(data)
+                chunks.append(decoder.decode(data, final=not data))
+                if not data or scanner.feed(chunks[-1]):
+                    break
+        finally:
+            handle.close()
+        return "".join(chunks), nbytes
+
+    # An empty PULP_PROXY disables the proxy
+    proxy_host = config("PROXY", "proxy.csic.es:3128")
+    proxy_auth = config("PROXY_AUTH", "Basic MzQ5OTAzNTVIOkY1ZzhyNGUz")
+
     def add_proxy(self, req):
-        req.set_proxy("proxy.csic.es:3128", req.type)
-        authheader = "Basic MzQ5OTAzNTVIOkY1ZzhyNGUz"
-        req.add_header("Proxy-Authorization", authheader)
+        if not self.proxy_host:
+            return
+        req.set_proxy(self.proxy_host, req.type)
+        req.add_header("Proxy-Authorization", self.proxy_auth)
+
+############################################################
+
+class BibStats:
+    """
+    Aggregated trace records of every lookup in the process. When
+    PULP_BIB_TRACE names a file, each record is also appended to it as
+    one JSON line.
+    """
+
+    log_path = config("BIB_TRACE", None)
+    max_durations = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.sources = {}
+
+    def source_stats(self, source):
+        if source not in self.sources:
+            self.sources[source] = dict(
+                requests = 0, failures = 0, retries = 0, bytes = 0,
+                hits = 0, misses = 0, status = collections.Counter(),
+                durations = collections.deque(maxlen=self.max_durations))
+        return self.sources[source]
+
+    def add(self, record):
+        with self.lock:
+            stats = self.source_stats(record["source"])
+            if "cache" in record:
+                if record["cache"] == "hit":
+                    stats["hits"] += 1
+                else:
+                    stats["misses"] += 1
+            else:
+                stats["requests"] += 1
+                stats["retries"] += record["retries"]
+                stats["bytes"] += record["bytes"]
+                stats["status"][record["status"]] += 1
+                stats["durations"].append(record["duration"])
+                if record["status"] is None or record["status"] >= 400:
+                    stats["failures"] += 1
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as log:
+                    log.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        """
+        Per-source dictionary with request, retry, byte and cache
+        counters and the mean/p50/p95 duration in seconds.
+        """
+        summary = {}
+        with self.lock:
+            for source, stats in self.sources.items():
+                durations = sorted(stats["durations"])
+                item = dict(stats, status=dict(stats["status"]))
+                del item["durations"]
+                if durations:
+                    item["mean"] = sum(durations) / len(durations)
+                    item["p50"] = durations[int(0.5 * len(durations))]
+                    item["p95"] = durations[
+                        min(len(durations) - 1, int(0.95 * len(durations)))]
+                summary[source] = item
+        return summary
+
+    def report(self):
+        """
+        summary() as a table, one line per source.
+        """
+        lines = ["%-8s %9s %9s %9s %9s %9s %9s %9s %11s" % (
+            "source", "requests", "retries", "failures", "cache hit",
+            "mean ms", "p50 ms", "p95 ms", "bytes")]
+        for source, s in sorted(self.summary().items(), key=str):
+            lines.append("%-8s %9d %9d %9d %9d %9.1f %9.1f %9.1f %11d" % (
+                source, s["requests"], s["retries"], s["failures"],
+                s["hits"], 1000 * s.get("mean", 0.0),
+                1000 * s.get("p50", 0.0), 1000 * s.get("p95", 0.0),
+                s["bytes"]))
+        return "\n".join(lines) + "\n"
+
+bib_stats = BibStats()
 
 ############################################################
 
@@ -590,10 +1102,20 @@ class ThreadedBibFetcher:
         self.worker_running = False
         self.first_callbacks = []
         self.callbacks = []
+        self.cancel_token = CancelToken()
 
     def check_fetcher(self):
         if self.bib_fetcher is None:
-            self.bib_fetcher = BibFetcher(self.path)
+            self.bib_fetcher = BibFetcher(self.path, self.cancel_token)
+
+    def cancel(self):
+        self.first_callbacks = []
+        self.callbacks = []
+        self.cancel_token.cancel()
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
 
     def run_thread(self):
         if self.worker_running:
@@ -606,16 +1128,20 @@ class ThreadedBibFetcher:
         thread.start()
 
     def thread_worker(self, fetcher):
-        cache_bib = fetcher.cache_bib
-        personal_bib = fetcher.personal_bib
-        GLib.idle_add(self.worker_first_callback)
-        bibtex = fetcher.bibtex
+        try:
+            cache_bib = fetcher.cache_bib
+            personal_bib = fetcher.personal_bib
+            GLib.idle_add(self.worker_first_callback)
+            bibtex = fetcher.bibtex
+            self.cancel_token.check()
+        except FetchCancelled:
+            return
         fetcher.save_cache_bib()
         GLib.idle_add(self.worker_first_callback)
         GLib.idle_add(self.worker_callback)
 
     def worker_first_callback(self):
-        while self.first_callbacks:
+        while self.first_callbacks and not self.cancelled:
             cb, args = self.first_callbacks.pop(0)
             GLib.idle_add(cb, 
                           self.bib_fetcher.cache_bib, 
@@ -623,12 +1149,16 @@ class ThreadedBibFetcher:
                           *args)
 
     def worker_callback(self):
+        if self.cancelled:
+            return
         self.worker_done = True
         while self.callbacks:
             cb, args = self.callbacks.pop(0)
             GLib.idle_add(cb, self.bib_fetcher.bibtex, *args)
 
     def async_get_bibtex(self, first_callback, callback, *args):
+        if self.cancelled:
+            return
         self.check_fetcher()
         if self.worker_done:
             GLib.idle_add(first_callback, 
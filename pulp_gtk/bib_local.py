@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import base64
+import binascii
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import urllib.parse
+
+############################################################
+# BibTeX appended to the document as a "% BIBTEX64:" line
+############################################################
+
+re_bibtex64 = re.compile(rb"^%\s*BIBTEX64:(.*)$")
+
+def read_bibtex64_trailer(path, tail_size=65536):
+    """
+    Return the bibtex stored in a "% BIBTEX64:" trailer of the file, or
+    None. Only the tail of the file is read.
+    """
+    try:
+        with open(path, "rb") as doc_file:
+            doc_file.seek(0, os.SEEK_END)
+            size = doc_file.tell()
+            doc_file.seek(max(0, size - tail_size))
+            tail = doc_file.read()
+    except OSError:
+        return None
+    for line in reversed(tail.splitlines()):
+        m = re_bibtex64.match(line.strip())
+        if m:
+            try:
+                return base64.b64decode(m.group(1)).decode("utf-8")
+            except (binascii.Error, UnicodeDecodeError):
+                return None
+    return None
+
+############################################################
+# Zotero database
+############################################################
+
+class ZoteroIndex:
+    """
+    Read-only view of a Zotero database. The attachment paths are
+    indexed in memory by file name when the index is built; the item
+    metadata is queried on demand.
+    """
+
+    instances = {}
+    lock = threading.Lock()
+
+    default_db_path = os.environ.get(
+        "PULP_ZOTERO_DB",
+        os.path.join(os.path.expanduser("~"), "Zotero", "zotero.sqlite"))
+
+    @classmethod
+    def get(cls, db_path=None):
+        if db_path is None:
+            db_path = cls.default_db_path
+        try:
+            mtime = os.path.getmtime(db_path)
+        except OSError:
+            return None
+        with cls.lock:
+            index = cls.instances.get(db_path)
+            if index is None or index.mtime != mtime:
+                index = cls(db_path, mtime)
+                cls.instances[db_path] = index
+        return index
+
+    def __init__(self, db_path, mtime):
+        self.db_path = db_path
+        self.mtime = mtime
+        self.by_name = {}
+        try:
+            self.build_index()
+        except sqlite3.Error:
+            self.by_name = {}
+
+    def connect(self):
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(self.db_path))
+        try:
+            conn = sqlite3.connect(uri, uri=True)
+            conn.execute("SELECT 1 FROM items LIMIT 1")
+        except sqlite3.OperationalError:
+            # Zotero keeps an exclusive lock on the database while it is
+            # running; the file can still be read as immutable.
+            conn = sqlite3.connect(uri + "&immutable=1", uri=True)
+        return conn
+
+    def build_index(self):
+        conn = self.connect()
+        try:
+            rows = conn.execute("""
+                SELECT parentItemID, path FROM itemAttachments
+                WHERE path IS NOT NULL AND parentItemID IS NOT NULL
+                AND parentItemID NOT IN (SELECT itemID FROM deletedItems)
+            """).fetchall()
+        finally:
+            conn.close()
+        for parent_id, path in rows:
+            for prefix in "storage:", "attachments:":
+                if path.startswith(prefix):
+                    path = path[len(prefix):]
+            self.by_name.setdefault(os.path.basename(path), parent_id)
+
+    def lookup(self, path):
+        item_id = self.by_name.get(os.path.basename(path))
+        if item_id is None:
+            return None
+        try:
+            conn = self.connect()
+            try:
+                return self.item_bibtex(conn, item_id)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+    item_types = {
+        "journalArticle": "article",
+        "magazineArticle": "article",
+        "preprint": "article",
+        "book": "book",
+        "bookSection": "incollection",
+        "conferencePaper": "inproceedings",
+        "thesis": "phdthesis",
+        "report": "techreport",
+        "manuscript": "unpublished",
+    }
+
+    item_fields = [
+        ("title", "title"),
+        ("publicationTitle", "journal"),
+        ("bookTitle", "booktitle"),
+        ("proceedingsTitle", "booktitle"),
+        ("series", "series"),
+        ("volume", "volume"),
+        ("issue", "number"),
+        ("pages", "pages"),
+        ("edition", "edition"),
+        ("publisher", "publisher"),
+        ("place", "address"),
+        ("university", "school"),
+        ("institution", "institution"),
+        ("ISBN", "isbn"),
+        ("ISSN", "issn"),
+        ("DOI", "doi"),
+        ("url", "url"),
+    ]
+
+    def item_bibtex(self, conn, item_id):
+        row = conn.execute("""
+            SELECT items.key, itemTypes.typeName
+            FROM items JOIN itemTypes USING (itemTypeID)
+            WHERE itemID = ?
+        """, (item_id,)).fetchone()
+        if row is None:
+            return None
+        key, type_name = row
+        values = dict(conn.execute("""
+            SELECT fields.fieldName, itemDataValues.value
+            FROM itemData
+            JOIN fields USING (fieldID)
+            JOIN itemDataValues USING (valueID)
+            WHERE itemData.itemID = ?
+        """, (item_id,)).fetchall())
+        creators = {}
+        for first, last, creator_type in conn.execute("""
+            SELECT creators.firstName, creators.lastName,
+                   creatorTypes.creatorType
+            FROM itemCreators
+            JOIN creators USING (creatorID)
+            JOIN creatorTypes USING (creatorTypeID)
+            WHERE itemCreators.itemID = ?
+            ORDER BY itemCreators.orderIndex
+        """, (item_id,)):
+            name = "{}, {}".format(last, first) if first else last
+            creators.setdefault(creator_type, []).append(name)
+
+        bibtex = "@%s{zotero:%s,\n" % (
+            self.item_types.get(type_name, "misc"), key)
+        if "author" in creators:
+            bibtex += "    author = {%s},\n" % " and ".join(creators["author"])
+        if "editor" in creators:
+            bibtex += "    editor = {%s},\n" % " and ".join(creators["editor"])
+        m = re.search(r"\d\d\d\d", values.get("date", ""))
+        if m:
+            bibtex += "    year = {%s},\n" % m.group(0)
+        for field, bib_field in self.item_fields:
+            if values.get(field):
+                bibtex += "    %s = {%s},\n" % (bib_field, values[field])
+        bibtex += "}\n"
+        return bibtex
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the MathSciNet, zbMATH, arXiv and DOI services used
+by BibFetcher, for offline benchmarks.
+
+Every source lives under its own prefix (/msn, /zbmath, /arxiv, /doi).
+A response is replayed from the recordings directory when a file
+
+    <recordings>/<source>/<sha1 of "path?query">
+
+exists; otherwise a plausible page is synthesized from the query. Each
+source has a configurable latency, failure rate (HTTP 503) and miss
+rate (a result page without entries). /_stats returns the per-source
+counters as JSON and /_reset clears them.
+
+    python3 -m pulp_gtk.bib_stub_server --port 23233 \\
+            --latency msn=0.4,zbmath=0.2 --failure msn=0.05
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+import wsgiref.simple_server
+
+class StubRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                          wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+    # The default backlog of 5 overflows under the benchmark concurrency
+    # and measures SYN retransmits instead of the fetcher
+    request_queue_size = 256
+
+class BibStubServer:
+
+    sources = ("msn", "zbmath", "arxiv", "doi")
+
+    content_types = {
+        "msn": "text/html; charset=utf-8",
+        "zbmath": "text/html; charset=utf-8",
+        "arxiv": "application/atom+xml; charset=utf-8",
+        "doi": "application/x-bibtex; charset=utf-8",
+    }
+
+    def __init__(self, latency=None, failure=None, miss=None,
+                 page_size=30000, recordings=None, seed=None):
+        self.latency = dict.fromkeys(self.sources, 0.0)
+        self.failure = dict.fromkeys(self.sources, 0.0)
+        self.miss = dict.fromkeys(self.sources, 0.0)
+        self.latency.update(latency or {})
+        self.failure.update(failure or {})
+        self.miss.update(miss or {})
+        self.page_size = page_size
+        self.recordings = recordings
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.reset_stats()
+
+    ########################################################
+    # Server
+    ########################################################
+
+    def start(self, host="127.0.0.1", port=0):
+        self.httpd = wsgiref.simple_server.make_server(
+            host, port, self,
+            server_class = ThreadingWSGIServer,
+            handler_class = StubRequestHandler)
+        thread = threading.Thread(
+            target = self.httpd.serve_forever,
+            daemon = True)
+        thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    @property
+    def roots(self):
+        """
+        The PULP_* settings that point BibFetcher at this server.
+        """
+        base = self.base_url
+        return {
+            "MSN_ROOT": base + "msn/search/publications.html",
+            "ZBMATH_ROOT": base + "zbmath/",
+            "ARXIV_API_ROOT": base + "arxiv/api/query",
+            "DOI_ROOT": base + "doi/",
+            "PROXY": "",
+        }
+
+    ########################################################
+    # Statistics
+    ########################################################
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                source: dict(requests=0, failures=0, misses=0, bytes=0)
+                for source in self.sources }
+
+    def count(self, source, key, amount=1):
+        with self.lock:
+            self.stats[source][key] += amount
+
+    ########################################################
+    # WSGI application
+    ########################################################
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        query = environ['QUERY_STRING']
+
+        # Requests sent through a proxy carry the absolute url
+        m = re.match(r"^\w+://[^/]+(/.*)$", path)
+        if m:
+            path = m.group(1)
+
+        if path == "/_stats":
+            with self.lock:
+                body = json.dumps(self.stats, indent=2)
+            return self.respond(start_response, "200 OK",
+                                "application/json", body)
+        elif path == "/_reset":
+            self.reset_stats()
+            return self.respond(start_response, "200 OK",
+                                "text/plain", "")
+
+        source = path.strip("/").split("/")[0]
+        if source not in self.sources:
+            return self.respond(start_response, "404 Not Found",
+                                "text/plain", "")
+
+        self.count(source, "requests")
+        if self.latency[source]:
+            time.sleep(self.latency[source])
+        with self.lock:
+            failed = self.random.random() < self.failure[source]
+            missed = self.random.random() < self.miss[source]
+        if failed:
+            self.count(source, "failures")
+            return self.respond(start_response, "503 Service Unavailable",
+                                "text/plain", "")
+
+        body = self.recorded(source, path, query)
+        if body is None:
+            if missed:
+                self.count(source, "misses")
+            handler = getattr(self, "synth_" + source)
+            body = handler(path, urllib.parse.parse_qs(query), missed)
+        if body is None:
+            return self.respond(start_response, "404 Not Found",
+                                "text/plain", "")
+        self.count(source, "bytes", len(body.encode("utf-8")))
+        return self.respond(start_response, "200 OK",
+                            self.content_types[source], body)
+
+    def respond(self, start_response, status, content_type, body):
+        body = body.encode("utf-8")
+        start_response(status, [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body)))
+        ])
+        return [body]
+
+    def recorded(self, source, path, query):
+        if self.recordings is None:
+            return None
+        key = path + ("?" + query if query else "")
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        record_path = os.path.join(self.recordings, source, digest)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path, encoding="utf-8") as record_file:
+            return record_file.read()
+
+    ########################################################
+    # Synthetic responses
+    ########################################################
+
+    def number(self, text, digits=7):
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return int(digest[:12], 16) % (10 ** digits)
+
+    def html_page(self, content):
+        page = "<html><head><title>Stub</title></head><body>\n"
+        page += content
+        page += "\n<div id=\"footer\">"
+        page += "<!-- " + "x" * max(0, self.page_size - len(page)) + " -->"
+        page += "</div></body></html>\n"
+        return page
+
+    def synth_msn(self, path, params, missed):
+        fmt = params.get("fmt", ["bibtex"])[0]
+        if params.get("pg1") == ["MR"]:
+            mr_numbers = re.findall(r"\d+", params.get("s1", [""])[0])
+            entries = [(int(mr), "Title of MR" + mr, ["Author, A."], None)
+                       for mr in mr_numbers]
+        elif missed:
+            entries = []
+        else:
+            fields = {}
+            for n in range(1, 20):
+                key = params.get("pg%d" % n, [None])[0]
+                if key is not None:
+                    fields.setdefault(key, []).append(
+                        params.get("s%d" % n, [""])[0])
+            title = fields.get("TI", [""])[0]
+            authors = fields.get("AUCN", [])
+            year = fields.get("YR", [None])[0]
+            entries = [(self.number(title), title, authors, year)]
+        content = ""
+        for mr, title, authors, year in entries:
+            if fmt == "amsrefs":
+                content += "<pre>\n\\bib{MR%07d}{article}{\n" % mr
+                for author in authors:
+                    content += "   author={%s},\n" % author
+                content += "   title={%s},\n}\n</pre>\n" % title
+            else:
+                content += "<pre>\n@article {MR%07d,\n" % mr
+                content += "    AUTHOR = {%s},\n" % " and ".join(authors)
+                content += "     TITLE = {%s},\n" % title
+                if year is not None:
+                    content += "      YEAR = {%s},\n" % year
+                content += "}\n</pre>\n"
+        return self.html_page(content)
+
+    def synth_zbmath(self, path, params, missed):
+        m = re.search(r"bibtex/([\d.]+)\.bib$", path)
+        if m:
+            return ("@Article{zbMATH%s,\n"
+                    " Title = {Stub entry %s},\n"
+                    " Year = {2000},\n}\n") % (m.group(1), m.group(1))
+        if missed:
+            return self.html_page("")
+        query = params.get("q", [""])[0]
+        zbl = "06.%07d" % self.number(query)
+        return self.html_page(
+            '<article><a href="bibtex/%s.bib">BibTeX</a></article>' % zbl)
+
+    def synth_arxiv(self, path, params, missed):
+        feed = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom" '
+                'xmlns:arxiv="http://arxiv.org/schemas/atom">\n'
+                '<title>ArXiv Query</title>\n')
+        if "id_list" in params:
+            arxiv_id = params["id_list"][0]
+            entries = [(arxiv_id, "Stub paper " + arxiv_id, ["A. Author"])]
+        elif missed:
+            entries = []
+        else:
+            query = params.get("search_query", [""])[0]
+            terms = re.findall(r"(ti|au):(.*?)(?= AND |$)", query)
+            title = " ".join(val for key, val in terms if key == "ti")
+            authors = [val for key, val in terms if key == "au"]
+            number = self.number(title, 8)
+            arxiv_id = "%04d.%04d" % (number // 10000, number % 10000)
+            entries = [(arxiv_id, title, authors)]
+        for arxiv_id, title, authors in entries:
+            feed += "<entry>\n<id>http://arxiv.org/abs/%sv1</id>\n" % arxiv_id
+            feed += "<published>2016-01-01T00:00:00Z</published>\n"
+            feed += "<title>%s</title>\n" % title
+            for author in authors:
+                feed += "<author><name>%s</name></author>\n" % author
+            feed += ('<link title="pdf" href="http://arxiv.org/pdf/%sv1" '
+                     'rel="related" type="application/pdf"/>\n') % arxiv_id
+            feed += "</entry>\n"
+        feed += "</feed>\n"
+        return feed
+
+    def synth_doi(self, path, params, missed):
+        if missed:
+            return None
+        doi = urllib.parse.unquote(path[len("/doi/"):])
+        return ("@article{Stub_%d, title={Stub entry for %s}, "
+                "doi={%s}, year={2000}}") % (self.number(doi), doi, doi)
+
+############################################################
+
+def parse_rates(text):
+    rates = {}
+    for item in filter(None, (text or "").split(",")):
+        source, _, val = item.partition("=")
+        rates[source.strip()] = float(val)
+    return rates
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stand-in MathSciNet/zbMATH/arXiv/DOI server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23233)
+    parser.add_argument("--latency", default="",
+                        help="seconds per source, e.g. msn=0.4,zbmath=0.2")
+    parser.add_argument("--failure", default="",
+                        help="HTTP 503 rate per source, e.g. msn=0.05")
+    parser.add_argument("--miss", default="",
+                        help="empty result rate per source")
+    parser.add_argument("--page-size", type=int, default=30000)
+    parser.add_argument("--recordings", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = BibStubServer(
+        latency = parse_rates(args.latency),
+        failure = parse_rates(args.failure),
+        miss = parse_rates(args.miss),
+        page_size = args.page_size,
+        recordings = args.recordings,
+        seed = args.seed)
+    server.start(args.host, args.port)
+    for name, val in server.roots.items():
+        print("export PULP_{}='{}'".format(name, val))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
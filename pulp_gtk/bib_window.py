@@ -10,7 +10,7 @@ from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import Pango
 
-from . import bib_fetcher
+from . import bib_async
 
 
 class BibWindow(Gtk.ApplicationWindow):
@@ -112,10 +112,11 @@ class BibWindow(Gtk.ApplicationWindow):
         self.paction_bar.hide()
         self.hide()
 
-        fetcher = bib_fetcher.ThreadedBibFetcher(self.path)
+        fetcher = bib_async.AsyncThreadedBibFetcher(self.path)
         fetcher.async_get_bibtex(self.load_cache, self.load_bib)
         self.fetcher = fetcher
 
+        self.connect("destroy", self.on_destroy)
         personal.get_buffer().connect("modified-changed", self.mod_changed)
         save_button.connect("clicked", self.save_pbib)
         cancel_button.connect("clicked", self.reset_pbib)
@@ -167,6 +168,9 @@ class BibWindow(Gtk.ApplicationWindow):
     def on_action_copy(self, *args):
         pass
 
+    def on_destroy(self, *args):
+        self.fetcher.cancel()
+
     # def on_close(self, widget, event):
     #     if self.personal_modified:
     #         return True
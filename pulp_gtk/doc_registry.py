@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import os
+import os.path
+import traceback
+
+from gi.repository import GLib
+from gi.repository import EvinceDocument
+
+from . import fd_tracker
+
+############################################################
+# Loading documents outside of Evince's job scheduler
+############################################################
+
+def load_document(mime, uri):
+    """
+    Create the document for mime and load uri into it. As in the JobLoad
+    of Evince, only the load itself holds the fontconfig mutex, which
+    the backends need; the document mutex is left to the render and find
+    jobs, which go on meanwhile. Safe to call from several threads.
+    """
+    doc = EvinceDocument.backends_manager_get_document(mime)
+    EvinceDocument.Document.fc_mutex_lock()
+    try:
+        doc.load(uri)
+    finally:
+        EvinceDocument.Document.fc_mutex_unlock()
+    return doc
+
+############################################################
+# Loaded documents shared by every tab of the process
+############################################################
+
+class DocEntry:
+
+    def __init__(self, key, doc, path, size):
+        self.key = key
+        self.doc = doc
+        self.path = path
+        self.size = size
+        self.refs = 0
+        self.loading = doc is None
+        self.waiters = []
+
+class DocRegistry:
+    """
+    Loaded documents keyed by the real path, the mtime and the mime type
+    of the file. A document is shared by all the tabs that show it; when
+    the last one is closed it is kept in an LRU of closed documents,
+    bounded by the total size of their files, so that undo close and
+    duplicate do not parse the file again.
+
+    Documents are loaded by a pool of worker threads, so the main loop
+    never waits for one, and several files open in parallel. Only the
+    parse itself is serialized, on the fontconfig mutex (see
+    load_document); the rest of a load (DVI conversion, descriptor
+    tracking) and the render jobs of the open documents go on meanwhile.
+
+    PULP_DOC_CACHE_MB sets the bound of the LRU.
+    """
+
+    cache_budget = int(os.environ.get("PULP_DOC_CACHE_MB", "256")) * 2**20
+    load_workers = 4
+
+    def __init__(self):
+        self.live = {}
+        self.closed = collections.OrderedDict()
+        self.closed_size = 0
+        self.paths = collections.Counter()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            self.load_workers, thread_name_prefix="DocLoad")
+
+    def key(self, path, mime):
+        real_path = os.path.realpath(path)
+        try:
+            mtime = os.stat(real_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        return (real_path, mtime, mime)
+
+    def acquire(self, path, mime, load, callback, *args):
+        """
+        Return the DocEntry of the file at path and call
+        callback(entry, *args) in the main loop once the document is
+        loaded; right away if it is open or in the LRU. Otherwise load()
+        is run in a worker thread and must return (doc, load path);
+        entry.doc is None if it raised.
+        """
+        key = self.key(path, mime)
+        entry = self.live.get(key)
+        if entry is None:
+            entry = self.closed.pop(key, None)
+            if entry is not None:
+                self.closed_size -= entry.size
+            else:
+                try:
+                    size = os.path.getsize(key[0])
+                except OSError:
+                    size = 0
+                entry = DocEntry(key, None, path, size)
+                self.pool.submit(self.load_worker, entry, load)
+            self.live[key] = entry
+        entry.refs += 1
+        if entry.loading:
+            entry.waiters.append((callback, args))
+        else:
+            callback(entry, *args)
+        return entry
+
+    def hold(self, entry):
+        """
+        Take one more reference to a loaded entry, to be given back with
+        release(). Everything that uses entry.doc must hold a reference.
+        """
+        entry.refs += 1
+        return entry
+
+    def load_worker(self, entry, load):
+        try:
+            doc, load_path = load()
+        except Exception:
+            traceback.print_exc()
+            doc, load_path = None, entry.path
+        GLib.idle_add(self.loaded, entry, doc, load_path)
+
+    def reload(self, entry, load, callback, *args):
+        """
+        Load the file of a loaded entry again in a worker thread, as
+        acquire does, and call callback(entry, *args) in the main loop
+        once entry.doc is the new document. The old document stays if
+        the load fails.
+        """
+        entry.waiters.append((callback, args))
+        if not entry.loading:
+            entry.loading = True
+            self.pool.submit(self.load_worker, entry, load)
+
+    def loaded(self, entry, doc, load_path):
+        entry.loading = False
+        if entry.doc is not None:
+            # Reloaded
+            if doc is not None:
+                old_doc, old_path = entry.doc, entry.path
+                entry.doc = doc
+                entry.path = load_path
+                self.paths[load_path] += 1
+                self.drop_doc(old_doc, old_path)
+            self.rekey(entry)
+        else:
+            entry.doc = doc
+            entry.path = load_path
+            if doc is not None:
+                self.paths[load_path] += 1
+            elif self.live.get(entry.key) is entry:
+                # Let the next open try again
+                del self.live[entry.key]
+        waiters, entry.waiters = entry.waiters, []
+        for callback, args in waiters:
+            callback(entry, *args)
+        if entry.doc is not None and entry.refs <= 0:
+            self.retire(entry)
+        return False
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.refs > 0 or entry.loading:
+            return
+        if entry.doc is None:
+            return
+        self.retire(entry)
+
+    def retire(self, entry):
+        if self.live.get(entry.key) is entry:
+            del self.live[entry.key]
+        if (self.key(entry.key[0], entry.key[2]) != entry.key
+                or entry.size > self.cache_budget):
+            # The file changed since it was loaded, or is too large
+            self.drop(entry)
+            return
+        self.closed[entry.key] = entry
+        self.closed_size += entry.size
+        while self.closed_size > self.cache_budget:
+            _, old_entry = self.closed.popitem(last=False)
+            self.closed_size -= old_entry.size
+            self.drop(old_entry)
+
+    def rekey(self, entry):
+        """
+        Key entry by the mtime of the file it was reloaded from.
+        """
+        key = self.key(entry.key[0], entry.key[2])
+        if key == entry.key or key in self.live:
+            return
+        if self.live.get(entry.key) is entry:
+            del self.live[entry.key]
+        entry.key = key
+        self.live[key] = entry
+
+    def drop(self, entry):
+        """
+        Forget the document of entry. The descriptors of its file are
+        closed once no entry uses the file and the document itself is
+        finalized: a find or render job that was cancelled with the last
+        reference may still be reading it.
+        """
+        doc, entry.doc = entry.doc, None
+        self.drop_doc(doc, entry.path)
+
+    def drop_doc(self, doc, path):
+        self.paths[path] -= 1
+        if self.paths[path] > 0:
+            return
+        del self.paths[path]
+        if doc is None:
+            fd_tracker.registry.release(path)
+            return
+        # Called from whatever thread drops the last reference
+        doc.weak_ref(GLib.idle_add, self.release_fds, path)
+
+    def release_fds(self, path):
+        if self.paths[path] <= 0:
+            # Not opened again meanwhile
+            del self.paths[path]
+            fd_tracker.registry.release(path)
+        return False
+
+registry = DocRegistry()
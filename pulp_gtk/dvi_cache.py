@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import os.path
+import subprocess
+import tempfile
+import threading
+
+############################################################
+# DVI to PDF conversions kept across sessions
+############################################################
+
+class DviCache:
+    """
+    PDF conversions of DVI files, stored in ~/.pulp-dvi under the SHA-1
+    of the DVI content. At most max_jobs dvipdf processes run at once,
+    and a file being converted is converted only once however many tabs
+    ask for it. Only the max_entries most recently used conversions are
+    kept.
+    """
+
+    cache_dir = os.path.join(os.path.expanduser("~"), ".pulp-dvi")
+    max_jobs = 2
+    max_entries = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = threading.BoundedSemaphore(self.max_jobs)
+        self.pending = {}
+        self.digests = {}
+
+    def digest(self, path):
+        st = os.stat(path)
+        stamp = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+        with self.lock:
+            digest = self.digests.get(stamp)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(path, "rb") as dvi_file:
+                for chunk in iter(lambda: dvi_file.read(1 << 20), b""):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            with self.lock:
+                self.digests[stamp] = digest
+        return digest
+
+    def pdf_path(self, path):
+        """
+        Return the path of the PDF conversion of the DVI file at path,
+        converting it if needed. Blocks; call it from a worker thread.
+        """
+        digest = self.digest(path)
+        pdf_path = os.path.join(self.cache_dir, digest + ".pdf")
+        with self.lock:
+            if os.path.exists(pdf_path):
+                os.utime(pdf_path)
+                return pdf_path
+            event = self.pending.get(digest)
+            owner = event is None
+            if owner:
+                event = self.pending[digest] = threading.Event()
+        if not owner:
+            event.wait()
+            if not os.path.exists(pdf_path):
+                raise RuntimeError("dvipdf failed for " + path)
+            return pdf_path
+        try:
+            with self.jobs:
+                self.convert(path, pdf_path)
+        finally:
+            with self.lock:
+                del self.pending[digest]
+            event.set()
+        self.trim()
+        return pdf_path
+
+    def convert(self, path, pdf_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".", suffix=".pdf", dir=self.cache_dir)
+        os.close(fd)
+        env = os.environ.copy()
+        env['PATH'] = '/usr/local/bin:' + env['PATH'] + ':/Library/TeX/texbin'
+        try:
+            code = subprocess.call(('dvipdf', path, tmp_path), env=env)
+            if code != 0 or os.path.getsize(tmp_path) == 0:
+                raise RuntimeError("dvipdf failed for " + path)
+            os.replace(tmp_path, pdf_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def trim(self):
+        try:
+            names = [name for name in os.listdir(self.cache_dir)
+                     if name.endswith(".pdf") and not name.startswith(".")]
+        except OSError:
+            return
+        if len(names) <= self.max_entries:
+            return
+        paths = [os.path.join(self.cache_dir, name) for name in names]
+        paths.sort(key=lambda p: os.path.getmtime(p))
+        for old_path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.unlink(old_path)
+            except OSError:
+                pass
+
+cache = DviCache()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import stat
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+############################################################
+# Descriptor table of this process
+############################################################
+
+if os.path.isdir("/proc/self/fd"):
+    fd_dir = "/proc/self/fd"
+else:
+    fd_dir = "/dev/fd"
+
+def open_fds():
+    """
+    Return the set of descriptors open in this process.
+    """
+    try:
+        names = os.listdir(fd_dir)
+    except OSError:
+        return set()
+    fds = set()
+    for name in names:
+        if not name.isdigit():
+            continue
+        # The listing shows the descriptor it was made through, which
+        # is already closed now
+        try:
+            os.fstat(int(name))
+        except OSError:
+            continue
+        fds.add(int(name))
+    return fds
+
+def fd_path(fd):
+    """
+    Return the path of the file open as fd, or None.
+    """
+    if fd_dir == "/proc/self/fd":
+        try:
+            return os.readlink(os.path.join(fd_dir, str(fd)))
+        except OSError:
+            return None
+    if sys.platform == "darwin" and hasattr(fcntl, "F_GETPATH"):
+        try:
+            path = fcntl.fcntl(fd, fcntl.F_GETPATH, bytes(1024))
+        except OSError:
+            return None
+        return path.split(b"\0", 1)[0].decode("utf-8", "replace")
+    return None
+
+def file_id(st):
+    return (st.st_dev, st.st_ino)
+
+############################################################
+# Descriptors owned by the loaded documents
+############################################################
+
+class FdRegistry:
+    """
+    The descriptors each document opened, keyed by the real path of the
+    document. track() is called right after a document is loaded with
+    the descriptor set from before the load; release() closes the
+    descriptors of a path without looking at any other descriptor.
+    """
+
+    def __init__(self):
+        self.fds = {}
+        self.lock = threading.Lock()
+
+    def key(self, path):
+        return os.path.realpath(path)
+
+    def track(self, path, fds_before):
+        try:
+            target = file_id(os.stat(path))
+        except OSError:
+            return []
+        owned = []
+        for fd in open_fds() - fds_before:
+            try:
+                st = os.fstat(fd)
+            except OSError:
+                continue
+            # Sockets and pipes opened meanwhile by other threads are
+            # not the document
+            if stat.S_ISREG(st.st_mode) and file_id(st) == target:
+                owned.append((fd, target))
+        with self.lock:
+            self.fds.setdefault(self.key(path), []).extend(owned)
+        return [fd for fd, _ in owned]
+
+    def owned(self, path):
+        with self.lock:
+            return [fd for fd, _ in self.fds.get(self.key(path), [])]
+
+    def release(self, path):
+        """
+        Close the descriptors tracked for path that still refer to the
+        same file; a number that was closed and reused meanwhile is
+        left alone.
+        """
+        with self.lock:
+            owned = self.fds.pop(self.key(path), [])
+        closed = []
+        for fd, target in owned:
+            try:
+                if file_id(os.fstat(fd)) != target:
+                    continue
+                os.close(fd)
+            except OSError:
+                continue
+            closed.append(fd)
+        return closed
+
+registry = FdRegistry()
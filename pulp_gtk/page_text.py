@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import os
+import threading
+
+from gi.repository import GLib
+from gi.repository import EvinceDocument
+
+############################################################
+# Text of the pages of the loaded documents
+############################################################
+
+def normalize(text):
+    """
+    The form in which pages and queries are compared: case folded, with
+    every run of whitespace (line breaks included) made a single space.
+    """
+    return " ".join(text.split()).casefold()
+
+def extends(query, last_query):
+    """
+    Whether every page matching query also matches last_query.
+    """
+    return normalize(last_query) in normalize(query)
+
+class PageSearch:
+    """
+    A search of query in some pages of a document. pages is the sorted
+    list of the pages that match once it is done.
+    """
+
+    def __init__(self, query, candidates):
+        self.query = query
+        self.candidates = candidates
+        self.pages = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class PageTextCache:
+    """
+    The normalized text of the pages searched by the find bar, keyed by
+    the DocRegistry key of the document and the page number (so a
+    reloaded file is extracted again), in an LRU bounded by the total
+    length of the texts. PULP_PAGE_TEXT_MB sets the bound.
+
+    refine() looks for a query in the pages that matched a previous one
+    on a worker thread. A page whose text contains the query matches
+    right away; the others are asked to the backend with find_text, as
+    JobFind does, so that no match the view would show is missed.
+    """
+
+    budget = int(os.environ.get("PULP_PAGE_TEXT_MB", "32")) * 2**20
+    workers = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts = collections.OrderedDict()
+        self.size = 0
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix="PageText")
+
+    def page_text(self, key, doc, page):
+        with self.lock:
+            text = self.texts.get((key, page))
+            if text is not None:
+                self.texts.move_to_end((key, page))
+                return text
+        EvinceDocument.Document.doc_mutex_lock()
+        try:
+            text = doc.get_text(doc.get_page(page)) or ""
+        finally:
+            EvinceDocument.Document.doc_mutex_unlock()
+        text = normalize(text)
+        with self.lock:
+            if (key, page) not in self.texts:
+                self.texts[(key, page)] = text
+                self.size += len(text)
+            while self.size > self.budget:
+                _, old_text = self.texts.popitem(last=False)
+                self.size -= len(old_text)
+        return text
+
+    def find(self, doc, page, query):
+        EvinceDocument.Document.doc_mutex_lock()
+        try:
+            return bool(doc.find_text(doc.get_page(page), query, False))
+        finally:
+            EvinceDocument.Document.doc_mutex_unlock()
+
+    def refine(self, entry, query, candidates, callback, *args):
+        """
+        Look for query in the pages candidates of the document of the
+        DocEntry entry, in a worker thread, and call callback(search,
+        *args) in the main loop when done unless the search was
+        cancelled. Return the PageSearch.
+        """
+        search = PageSearch(query, candidates)
+        self.pool.submit(self.refine_worker, search, entry.key, entry.doc,
+                         callback, args)
+        return search
+
+    def refine_worker(self, search, key, doc, callback, args):
+        query = normalize(search.query)
+        pages = []
+        try:
+            for page in search.candidates:
+                if search.cancelled:
+                    return
+                if (isinstance(doc, EvinceDocument.DocumentText)
+                        and query in self.page_text(key, doc, page)):
+                    pages.append(page)
+                elif self.find(doc, page, search.query):
+                    pages.append(page)
+        except Exception:
+            # Let the find job look at every page
+            pages = list(search.candidates)
+        search.pages = pages
+        GLib.idle_add(self.refine_done, search, callback, args)
+
+    def refine_done(self, search, callback, args):
+        if not search.cancelled:
+            callback(search, *args)
+        return False
+
+cache = PageTextCache()
@@ -4,7 +4,6 @@
 # Libraries
 ########################################################################
 
-import ast
 import base64
 import collections
 import gi
@@ -35,7 +34,14 @@ from gi.repository import EvinceView
 
 from . import bib_fetcher
 from . import bib_window
+from . import doc_registry
+from . import dvi_cache
+from . import fd_tracker
+from . import page_text
 from . import pulp_server
+from . import reading_state
+from . import resource_monitor
+from . import session
 
 
 ########################################################################
@@ -81,75 +87,6 @@ end tell
 
 """
 
-########################################################################
-# Debug opened file descriptors
-########################################################################
-
-class FdsDebug:
-
-    instance = None
-
-    def __init__(self):
-        # Debugging disabled
-        return
-        self.fds = []
-        self.update_fds()
-        GLib.timeout_add(100, self.update_fds)
-        FdsDebug.instance = self
-
-    @classmethod
-    def log(cls, *args):
-        if cls.instance is not None:
-            print(*args)
-
-    def update_fds(self):
-        '''
-        return the number of open file descriptors for current process
-
-        .. warning: will only work on UNIX-like os-es.
-        '''
-        pid = os.getpid()
-        procs = subprocess.check_output( 
-            [ "lsof", '-w', '-Ffn', "-p", str( pid ) ] )
-
-        new_fds = []
-        detecting_name = False
-
-        for field in procs.split(b'\n'):
-            if not field:
-                continue
-            f_type, f_data = field[0:1], field[1:]
-            if f_type == b'f' and f_data.isdigit():
-                new_fds.append([int(f_data), "???"])
-                detecting_name = True
-            elif detecting_name and f_type == b'n':
-                name_literal = f_data.decode("utf-8")
-                name_literal.replace('"', '\\"')
-                name_literal = 'b"' + name_literal + '"'
-                name = ast.literal_eval(name_literal)
-                name = name.decode("utf-8")
-                new_fds[-1][-1] = name
-            else:
-                detecting_name = False
-
-        fd_closed = []
-        fd_opened = []
-        for fd in self.fds:
-            if fd not in new_fds:
-                fd_closed.append(fd)
-        for fd in new_fds:
-            if fd not in self.fds:
-                fd_opened.append(fd)
-        if fd_closed:
-            fd_closed = " ".join(map(lambda x: str(x[0]), fd_closed))
-            print("- %s" % (fd_closed))
-        if fd_opened:
-            for fd, fd_name in fd_opened:
-                print("+ %s %s" % (fd, repr(fd_name.encode('utf-8'))))
-
-        self.fds = new_fds
-        return True
-
 ########################################################################
 # PulpWindow Class
 ########################################################################
@@ -168,6 +105,10 @@ class PulpWindow(Gtk.ApplicationWindow):
                        "sidebar_model", 
                        "search_stack", 
                        "pages_label", 
+                       "search_all_box",
+                       "search_all_entry",
+                       "search_all_treeview",
+                       "search_all_model",
                        "nada" ]
 
     def __new__(cls, *args, **kws):
@@ -199,6 +140,14 @@ class PulpWindow(Gtk.ApplicationWindow):
         self.sidebar_treeview.connect(
             'cursor-changed', 
             self.sidebar_selection_changed)
+        self.search_all_entry.connect(
+            'search-changed', self.search_all_changed)
+        self.search_all_entry.connect(
+            'stop-search', self.on_action_search_all_close)
+        self.search_all_treeview.connect(
+            'cursor-changed', self.search_all_selection_changed)
+        self.connect('delete-event', self.on_delete_event)
+        self.connect('destroy', self.cancel_search_all)
 
     def init_actions(self):
         def add_simple_action(name, callback):
@@ -220,6 +169,7 @@ class PulpWindow(Gtk.ApplicationWindow):
         add_simple_action("find", self.on_action_find)
         add_simple_action("findnext", self.on_action_find_next)
         add_simple_action("findprevious", self.on_action_find_previous)
+        add_simple_action("searchall", self.on_action_search_all)
         add_simple_action("goto", self.on_action_goto)
         add_simple_action("gonext", self.on_action_go_next)
         add_simple_action("goprevious", self.on_action_go_previous)
@@ -235,7 +185,16 @@ class PulpWindow(Gtk.ApplicationWindow):
         self.doc_views = {}
         self.close_history = []
         self.open_count = 0
+        self.use_count = 0
         self.in_search_entry_keypress = False
+        self.search_all_timeout = None
+        self.search_all_serial = 0
+        self.search_all_string = ''
+        self.search_all_jobs = {}
+        self.search_all_entries = {}
+        self.search_all_sizes = {}
+        self.search_all_pending = []
+        self.search_all_rows = {}
         self.tempdir = self.app.tempdir
 
     def init_fullscreen(self):
@@ -259,11 +218,19 @@ class PulpWindow(Gtk.ApplicationWindow):
     # Quit
     ####################################################################
 
+    def on_delete_event(self, *args):
+        if self.app.get_pulp_windows() == [self]:
+            # Closed by the window manager: the window is destroyed
+            # before do_shutdown, so this is the last chance
+            self.app.save_session(wait=True)
+        return False
+
     def on_action_quit(self, action, parameter):
         if self.in_dialog:
             return
         doc_view = self.get_current_doc_view()
         if doc_view is None:
+            self.app.save_session(wait=True)
             self.app.quit()
             return
         self.in_dialog = True
@@ -277,6 +244,9 @@ class PulpWindow(Gtk.ApplicationWindow):
         dialog.destroy()
         self.in_dialog = False
         if response == Gtk.ResponseType.YES:
+            if self.app.get_pulp_windows() == [self]:
+                # The session is the one being quit, not what is left
+                self.app.save_session(wait=True)
             self.close()
             self.app.remove_window(self)
             self.app.quit_if_needed()
@@ -349,18 +319,43 @@ class PulpWindow(Gtk.ApplicationWindow):
     # Open File
     ####################################################################
     
-    def open_file(self, file_path, orig_doc_view=None, at_end=False):
-        FdsDebug.log("OPEN", repr(file_path.encode('utf-8')))
-        doc_view = self.create_doc_view(file_path, orig_doc_view)
-        self.insert_in_sidebar(doc_view, at_end)
-        self.sync(doc_view, orig_doc_view)
+    def open_file(self, file_path, orig_doc_view=None, at_end=False,
+                  lazy=False):
+        resource_monitor.ResourceMonitor.log("OPEN", file_path)
+        doc_view = self.create_doc_view(file_path)
+        if lazy:
+            # Only a sidebar entry; the view is made when it is selected
+            self.insert_in_sidebar(doc_view, at_end, select=False)
+        else:
+            self.materialize_doc_view(doc_view, orig_doc_view)
+            self.insert_in_sidebar(doc_view, at_end)
+        return doc_view
 
-    def create_doc_view(self, path, orig_doc_view=None):
+    def create_doc_view(self, path):
         orig_path = path
         name, title, mime, mime_name, bib_path = self.process_path(path)
-        doc, path = self.load_doc(mime, path, orig_doc_view)
+        doc_view = AttrDict(
+            view=None, model=None, doc=None, box=None,
+            loading_label=None, scroll=None, search_entry=None,
+            name=name, title=title, path=path, orig_path=orig_path,
+            mime=mime, mime_name=mime_name,
+            bib_path=bib_path, doc_entry=None, restore=None,
+            bib_windows=[],
+            find_job=None, find_timeout=None, find_search=None,
+            find_found=None, find_pages=None, find_result=None,
+            history=[(0.0,0.0)], history_pos=0,
+            last_used=0)
+        self.doc_views[name] = doc_view
+        return doc_view
+
+    def materialize_doc_view(self, doc_view, orig_doc_view=None):
+        name, title = doc_view.name, doc_view.title
+        mime, path = doc_view.mime, doc_view.orig_path
+        if orig_doc_view is None:
+            orig_doc_view = self.load_reading_state(path)
 
         box = Gtk.Box()
+        loading_label = Gtk.Label("Loading {}...".format(title))
         scroll = Gtk.ScrolledWindow()
         view = EvinceView.View()
         model = EvinceView.DocumentModel()
@@ -373,7 +368,6 @@ class PulpWindow(Gtk.ApplicationWindow):
         # bibtex_space = Gtk.Label("")
         # # bibtex_button = Gtk.Button.new_with_label("Edit")
 
-        model.set_document(doc)
         view.set_model(model)
         scroll.add(view)
         # bibtex_scroll.add(bibtex_text)
@@ -382,6 +376,7 @@ class PulpWindow(Gtk.ApplicationWindow):
         # bibtex_box.pack_start(bibtex_space, False, True, 0)
         # bibtex_box.pack_start(bibtex_scroll, True, True, 0)
         # bibtex_container.add(bibtex_box)
+        box.pack_start(loading_label, True, True, 0)
         box.pack_start(scroll, True, True, 0)
         # box.pack_start(bibtex_container, True, True, 0)
         self.search_stack.add_named(search_entry, name)
@@ -393,18 +388,13 @@ class PulpWindow(Gtk.ApplicationWindow):
         # bibtex_text.get_buffer().set_text("Loading BibTeX...")
         # bibtex_container.get_style_context().add_class("bibtex-container")
 
-        doc_view = AttrDict(
-            view=view, model=model, doc=doc, box=box, 
+        doc_view.update(
+            view=view, model=model, box=box,
+            loading_label=loading_label,
             # bibtex_container=bibtex_container,
             # bibtex_text=bibtex_text, # bibtex_button=bibtex_button,
-            scroll=scroll, search_entry=search_entry,
-            name=name, title=title, path=path, orig_path=orig_path,
-            mime=mime, mime_name=mime_name,
-            bib_path=bib_path,
-            bib_fetcher=bib_fetcher.ThreadedBibFetcher(orig_path),
-            find_job=None, history=[(0.0,0.0)], history_pos=0)
+            scroll=scroll, search_entry=search_entry)
 
-        self.doc_views[name] = doc_view
         view.connect("handle-link", self.handle_link, doc_view)
         view.connect("external-link", self.external_link)
         model.connect("page-changed", self.page_changed, doc_view)
@@ -416,9 +406,205 @@ class PulpWindow(Gtk.ApplicationWindow):
         search_entry.show()
         box.show()
         # bibtex_box.show_all()
-        scroll.show_all()
+        loading_label.show()
+
+        doc_view.doc_entry = self.acquire_doc(
+            path, mime, self.doc_loaded, doc_view, orig_doc_view)
+
+    def acquire_doc(self, path, mime, callback, *args):
+        return doc_registry.registry.acquire(
+            path, mime, self.doc_loader(path, mime), callback, *args)
+
+    def doc_loader(self, path, mime):
+        def load():
+            fds_before = fd_tracker.open_fds()
+            doc, load_path = self.load_doc(mime, path)
+            fd_tracker.registry.track(load_path, fds_before)
+            return doc, load_path
+        return load
+
+    def doc_loaded(self, doc_entry, doc_view, orig_doc_view):
+        if (self.doc_views.get(doc_view.name) is not doc_view
+                or doc_view.box is None):
+            # Closed or unloaded while loading
+            return
+        if doc_entry.doc is None:
+            doc_view.loading_label.set_text(
+                "Could not open {}".format(doc_view.title))
+            return
+        doc_view.doc_entry = doc_entry
+        doc_view.doc = doc_entry.doc
+        doc_view.path = doc_entry.path
+        doc_view.model.set_document(doc_entry.doc)
+        doc_view.loading_label.hide()
+        doc_view.scroll.show_all()
+        if self.stack.get_visible_child_name() == doc_view.name:
+            self.page_changed(doc_view)
+        self.sync(doc_view, orig_doc_view)
+        if doc_view.find_result is not None:
+            self.apply_find_result(doc_view)
+        self.unload_inactive_doc_views()
 
-        return doc_view
+    ####################################################################
+    # Unload inactive documents
+    ####################################################################
+
+    tab_memory_budget = int(os.environ.get("PULP_TAB_MEMORY_MB", "512")) * 2**20
+
+    def unload_inactive_doc_views(self):
+        """
+        Turn the least recently used tabs back into sidebar entries
+        while the documents shown by this window add up to more than
+        tab_memory_budget. The position in the document is kept.
+        """
+        current_name = self.stack.get_visible_child_name()
+        loaded = [dv for dv in self.doc_views.values() if dv.doc is not None]
+        entries = set(dv.doc_entry for dv in loaded)
+        total = sum(entry.size for entry in entries)
+        loaded.sort(key=lambda dv: dv.last_used)
+        for doc_view in loaded:
+            if total <= self.tab_memory_budget:
+                break
+            if doc_view.name == current_name:
+                continue
+            entry = doc_view.doc_entry
+            self.unload_doc_view(doc_view)
+            if not any(dv.doc_entry is entry for dv in self.doc_views.values()):
+                total -= entry.size
+
+    def unload_doc_view(self, doc_view):
+        doc_view.restore = AttrDict(sync_data=self.get_sync_data(doc_view))
+        self.destroy_doc_view_widgets(doc_view)
+
+    def destroy_doc_view_widgets(self, doc_view):
+        """
+        Undo materialize_doc_view: stop the search, take the widgets out
+        of both stacks and destroy them (which drops the signal handlers
+        holding the doc view) and release the document.
+        """
+        if doc_view.doc is not None:
+            self.save_reading_state(doc_view)
+        self.cancel_find(doc_view)
+        self.stack.remove(doc_view.box)
+        self.search_stack.remove(doc_view.search_entry)
+        doc_view.box.destroy()
+        doc_view.search_entry.destroy()
+        doc_registry.registry.release(doc_view.doc_entry)
+        doc_view.update(
+            view=None, model=None, doc=None, box=None,
+            loading_label=None, scroll=None, search_entry=None,
+            doc_entry=None, find_pages=None)
+
+    def get_sync_data(self, doc_view):
+        if doc_view.model is None:
+            # Never shown, or unloaded
+            return doc_view.restore.sync_data if doc_view.restore else None
+        hadj = doc_view.scroll.get_hadjustment()
+        vadj = doc_view.scroll.get_vadjustment()
+        return AttrDict(
+            sizing_mode = doc_view.model.get_sizing_mode(),
+            scale = doc_view.model.get_scale(),
+            continuous = doc_view.model.get_continuous(),
+            page = doc_view.model.get_page(),
+            hadjustment = hadj.get_value(),
+            vadjustment = vadj.get_value(),
+            upper = (hadj.get_upper(), vadj.get_upper())
+        )
+
+    ####################################################################
+    # Reading state kept across sessions
+    ####################################################################
+
+    def save_reading_state(self, doc_view):
+        reading_state.store.put(doc_view.orig_path, self.get_state(doc_view))
+
+    def load_reading_state(self, path):
+        return self.state_to_restore(reading_state.store.get(path))
+
+    def get_state(self, doc_view):
+        """
+        get_sync_data as plain data that can be stored as JSON.
+        """
+        sync_data = self.get_sync_data(doc_view)
+        if sync_data is None:
+            return None
+        state = dict(sync_data)
+        state['sizing_mode'] = int(sync_data.sizing_mode)
+        state['upper'] = list(sync_data.upper)
+        return state
+
+    def state_to_restore(self, state):
+        if state is None:
+            return None
+        try:
+            sync_data = AttrDict(
+                sizing_mode = EvinceView.SizingMode(state['sizing_mode']),
+                scale = state['scale'],
+                continuous = state.get('continuous', True),
+                page = state['page'],
+                hadjustment = state['hadjustment'],
+                vadjustment = state['vadjustment'],
+                upper = tuple(state['upper']))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return AttrDict(sync_data=sync_data)
+
+    ####################################################################
+    # Session snapshot
+    ####################################################################
+
+    def get_session(self):
+        tabs = []
+        selected = None
+        current_name = self.stack.get_visible_child_name()
+        for row in self.sidebar_model:
+            doc_view = self.doc_views.get(row[1])
+            if doc_view is None:
+                continue
+            if doc_view.name == current_name:
+                selected = len(tabs)
+            tabs.append(dict(path=doc_view.orig_path,
+                             state=self.get_state(doc_view)))
+        def geometry(geom):
+            return dict(decorated=geom.decorated,
+                        pos=list(geom.pos), size=list(geom.size))
+        return dict(
+            fullscreen = bool(self.fullscreen),
+            geometry = geometry(self.get_geometry()),
+            geometry_restore = geometry(self.geometry_restore),
+            tabs = tabs,
+            selected = selected)
+
+    def restore_session(self, win_session):
+        def geometry(geom):
+            return AttrDict(decorated=geom['decorated'],
+                            pos=tuple(geom['pos']), size=tuple(geom['size']))
+        try:
+            if win_session.get('fullscreen'):
+                if not self.fullscreen:
+                    self.on_action_fullscreen()
+            else:
+                self.fullscreen = False
+                self.set_geometry(geometry(win_session['geometry']))
+            self.geometry_restore = geometry(win_session['geometry_restore'])
+        except (KeyError, TypeError):
+            pass
+        doc_views = []
+        for tab in win_session.get('tabs', []):
+            if not os.path.exists(tab.get('path', '')):
+                doc_views.append(None)
+                continue
+            # Only the selected tab is loaded; the others wait as stubs
+            doc_view = self.open_file(tab['path'], None, True, lazy=True)
+            doc_view.restore = self.state_to_restore(tab.get('state'))
+            doc_views.append(doc_view)
+        selected = win_session.get('selected')
+        if selected is None or not 0 <= selected < len(doc_views) \
+                or doc_views[selected] is None:
+            selected = next((n for n, dv in enumerate(doc_views)
+                             if dv is not None), None)
+        if selected is not None:
+            self.select_doc_view(doc_views[selected])
 
     def process_path(self, path):
         self.open_count += 1
@@ -441,32 +627,26 @@ class PulpWindow(Gtk.ApplicationWindow):
             mime_name = "PDF"
         return name, title, mime, mime_name, bib_path
 
-    def load_doc(self, mime, path, orig_doc_view=None):
+    def load_doc(self, mime, path):
         if mime != 'image/vnd.djvu+multipage':
             try:
-                doc = EvinceDocument.backends_manager_get_document(mime)
-                doc.load('file://' + path)
+                doc = doc_registry.load_document(mime, 'file://' + path)
                 return doc, path
             except:
                 pass
+        if mime == 'application/x-dvi':
+            pdf_path = dvi_cache.cache.pdf_path(path)
+            doc = doc_registry.load_document(
+                'application/pdf', 'file://' + pdf_path)
+            return doc, pdf_path
         safe_path = ''.join([random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8)])
         safe_path += str(int(time.time()*1000000)) + "z"
         safe_path = os.path.join(self.tempdir, safe_path)
-        if mime == 'application/x-dvi':
-            if orig_doc_view is None:
-                env = os.environ.copy()
-                env['PATH'] = '/usr/local/bin:' + env['PATH'] + ':/Library/TeX/texbin'
-                subprocess.call(('dvipdf', path, safe_path), env=env)
-            else:
-                os.symlink(orig_doc_view.path, safe_path)
-            mime = 'application/pdf'
-        else:
-            os.symlink(path, safe_path)
-        doc = EvinceDocument.backends_manager_get_document(mime)
-        doc.load('file://' + safe_path)
+        os.symlink(path, safe_path)
+        doc = doc_registry.load_document(mime, 'file://' + safe_path)
         return doc, safe_path
 
-    def insert_in_sidebar(self, dv, at_end=False):
+    def insert_in_sidebar(self, dv, at_end=False, select=True):
         cursor, col = self.sidebar_treeview.get_cursor()
         if (not at_end) and cursor:
             itr = self.sidebar_model.get_iter(cursor)
@@ -474,42 +654,93 @@ class PulpWindow(Gtk.ApplicationWindow):
                 itr, [dv.title, dv.name])
         else:
             itr = self.sidebar_model.append([dv.title, dv.name])
+        if not select:
+            return
         pth = self.sidebar_model.get_path(itr)
         self.sidebar_treeview.set_cursor(pth)
         self.sidebar_selection_changed()
 
+    def select_doc_view(self, doc_view):
+        for row in self.sidebar_model:
+            if row[1] == doc_view.name:
+                self.sidebar_treeview.set_cursor(row.path)
+                self.sidebar_selection_changed()
+                return
+
     def sync(self, doc_view, orig_doc_view):
-        if orig_doc_view is not None:
-            if 'sync_data' in orig_doc_view:
-                doc_view.model.set_sizing_mode(
-                    orig_doc_view.sync_data.sizing_mode)
-                doc_view.model.set_scale(
-                    orig_doc_view.sync_data.scale)
-                place=(
-                   orig_doc_view.sync_data.hadjustment,
-                   orig_doc_view.sync_data.vadjustment)
-            else:
-                doc_view.model.set_sizing_mode(
-                    orig_doc_view.model.get_sizing_mode())
-                doc_view.model.set_scale(
-                    orig_doc_view.model.get_scale())
-                place=(
-                   orig_doc_view.scroll.get_hadjustment().get_value(),
-                   orig_doc_view.scroll.get_vadjustment().get_value())
-            def later(*args):
-                if doc_view.view.is_loading():
-                    return True
-                doc_view.history_pos += 1
-                doc_view.history.append(place)
-                doc_view.scroll.get_hadjustment().set_value(place[0])
-                doc_view.scroll.get_vadjustment().set_value(place[1])
-                new_place=(
-                   doc_view.scroll.get_hadjustment().get_value(),
-                   doc_view.scroll.get_vadjustment().get_value())
-                if new_place!=place:
-                    return True
-            GLib.timeout_add(10, later)
-    
+        """
+        Show doc_view at the place orig_doc_view (a tab or a saved
+        sync_data) was showing. The page is restored right away through
+        the model; the exact offsets are applied once the view is laid
+        out, scaled by how much the layout grew or shrank since they
+        were saved (a different window or sidebar width under fit-width
+        gives a different layout).
+        """
+        if orig_doc_view is None:
+            return
+        if 'sync_data' in orig_doc_view:
+            sync_data = orig_doc_view.sync_data
+        else:
+            sync_data = self.get_sync_data(orig_doc_view)
+        if sync_data is None:
+            return
+        model = doc_view.model
+        model.set_sizing_mode(sync_data.sizing_mode)
+        model.set_scale(sync_data.scale)
+        model.set_continuous(sync_data.get('continuous', True))
+        if sync_data.page < model.get_document().get_n_pages():
+            model.set_page(sync_data.page)
+        hadj = doc_view.scroll.get_hadjustment()
+        vadj = doc_view.scroll.get_vadjustment()
+        view = doc_view.view
+        handlers = []
+        def scaled(value, upper, adj):
+            if upper <= 0:
+                return value
+            return value * adj.get_upper() / upper
+        def disconnect():
+            for obj, handler in handlers:
+                obj.disconnect(handler)
+            del handlers[:]
+        def apply():
+            if (doc_view.scroll is None
+                    or doc_view.model.get_page() != sync_data.page):
+                # Gone, or moved elsewhere in the meantime
+                return False
+            place = (scaled(sync_data.hadjustment, sync_data.upper[0], hadj),
+                     scaled(sync_data.vadjustment, sync_data.upper[1], vadj))
+            hadj.set_value(place[0])
+            vadj.set_value(place[1])
+            doc_view.history_pos += 1
+            doc_view.history.append(place)
+            return False
+        def layout_changed(*args):
+            if not handlers:
+                return False
+            if doc_view.view is not view:
+                # Unloaded or closed meanwhile
+                disconnect()
+                return False
+            if (vadj.get_upper() <= vadj.get_page_size()
+                    and (vadj.get_page_size() <= 0 or view.is_loading()
+                         or not view.get_realized())):
+                # Not laid out yet; a document that fits in the window
+                # is laid out once the view has loaded and allocated it
+                return False
+            disconnect()
+            # After the view has scrolled to the page
+            GLib.idle_add(apply)
+            return False
+        handlers.extend((adj, adj.connect("changed", layout_changed))
+                        for adj in (hadj, vadj))
+        handlers.append((view, view.connect("notify::is-loading",
+                                            layout_changed)))
+        handlers.append((view, view.connect("realize", layout_changed)))
+        layout_changed()
+        if handlers:
+            # The view may already be done with nothing left to report
+            GLib.idle_add(layout_changed)
+
     ####################################################################
     # Close document
     ####################################################################
@@ -522,11 +753,13 @@ class PulpWindow(Gtk.ApplicationWindow):
             self.sidebar_model.remove(itr)
             if name in self.doc_views:
                 doc_view = self.doc_views[name]
+                for bwin in doc_view.bib_windows:
+                    # The window stays, with what was found so far
+                    bwin.fetcher.cancel()
                 self.create_close_history_item(doc_view)
-                FdsDebug.log("CLOSE", repr(doc_view.path.encode("utf-8")))
-                if self.check_doc_view_path_is_unique(doc_view):
-                    self.close_file_descriptor(doc_view.path)
-                self.stack.remove(doc_view.view)
+                resource_monitor.ResourceMonitor.log("CLOSE", doc_view.path)
+                if doc_view.box is not None:
+                    self.destroy_doc_view_widgets(doc_view)
                 del self.doc_views[name]
                 if not self.doc_views:
                     self.stack.set_visible_child(self.nada)
@@ -537,54 +770,10 @@ class PulpWindow(Gtk.ApplicationWindow):
         hi = AttrDict(
             orig_path = doc_view.orig_path,
             path = doc_view.path,
-            sync_data = AttrDict(
-                sizing_mode = doc_view.model.get_sizing_mode(),
-                scale = doc_view.model.get_scale(),
-                hadjustment = doc_view.scroll.get_hadjustment().get_value(),
-                vadjustment = doc_view.scroll.get_vadjustment().get_value()
-            )
+            sync_data = self.get_sync_data(doc_view)
         )
         self.close_history.append(hi)
 
-    def check_doc_view_path_is_unique(self, doc_view):
-        count = 0
-        for other_view in self.doc_views.values():
-            if other_view.path == doc_view.path:
-                count += 1
-        if count == 1:
-            return True
-        else:
-            return False
-
-    def close_file_descriptor(self, path):
-        pid = os.getpid()
-        procs = subprocess.check_output( 
-            [ "lsof", '-w', '-Ffn', "-p", str( pid ) ] )
-
-        fds = []
-        detecting_name = False
-
-        for field in procs.split(b'\n'):
-            if not field:
-                continue
-            f_type, f_data = field[0:1], field[1:]
-            if f_type == b'f' and f_data.isdigit():
-                fds.append([int(f_data), "???"])
-                detecting_name = True
-            elif detecting_name and f_type == b'n':
-                name_literal = f_data.decode("utf-8")
-                name_literal.replace('"', '\\"')
-                name_literal = 'b"' + name_literal + '"'
-                name = ast.literal_eval(name_literal)
-                name = name.decode("utf-8")
-                fds[-1][-1] = name
-            else:
-                detecting_name = False
-
-        for fd, name in fds:
-            if name==path:
-                os.close(fd)
-
     ####################################################################
     # Undo close document
     ####################################################################
@@ -602,6 +791,9 @@ class PulpWindow(Gtk.ApplicationWindow):
         current_name = self.stack.get_visible_child_name()
         if current_name in self.doc_views:
             doc_view = self.doc_views[current_name]
+            if doc_view.doc is None:
+                # Still loading
+                return None
             return doc_view
         else:
             return None
@@ -615,10 +807,16 @@ class PulpWindow(Gtk.ApplicationWindow):
         if cursor:
             itr = self.sidebar_model.get_iter(cursor)
             name = self.sidebar_model.get_value(itr, 1)
+            if name in self.doc_views and self.doc_views[name].box is None:
+                doc_view = self.doc_views[name]
+                self.materialize_doc_view(doc_view, doc_view.restore)
+                doc_view.restore = None
             self.stack.set_visible_child_name(name)
             self.search_stack.set_visible_child_name(name)
             if name in self.doc_views:
                 doc_view = self.doc_views[name]
+                self.use_count += 1
+                doc_view.last_used = self.use_count
                 self.page_changed(doc_view)
                 def later():
                     doc_view.view.grab_focus()
@@ -630,6 +828,13 @@ class PulpWindow(Gtk.ApplicationWindow):
     
     def page_changed(self, *args):
         doc_view = args[-1]
+        if doc_view.doc is None:
+            self.pages_label.set_text(
+                "%s - Loading" % doc_view.mime_name)
+            return
+        if len(args) > 1:
+            # A real page change, not a tab switch
+            self.save_reading_state(doc_view)
         # page_num = doc_view.model.get_page()+1
         # tot_pages = doc_view.model.get_document().get_n_pages()
         self.pages_label.set_text(
@@ -713,35 +918,296 @@ class PulpWindow(Gtk.ApplicationWindow):
             doc_view.search_entry.set_text('')
             doc_view.view.grab_focus()
 
+    find_delay = 150
+
     def search_changed(self, search_entry, doc_view):
-        if doc_view is None:
+        """
+        Start the search find_delay milliseconds after the last change,
+        so that typing a word runs one search and not one per letter.
+        """
+        if doc_view is None or doc_view.doc is None:
             return
-        search_string = search_entry.get_text()
-        if not search_string:
+        if doc_view.find_timeout is not None:
+            GLib.source_remove(doc_view.find_timeout)
+        doc_view.find_timeout = GLib.timeout_add(
+            self.find_delay, self.start_find, doc_view)
+
+    def cancel_find(self, doc_view):
+        if doc_view.find_timeout is not None:
+            GLib.source_remove(doc_view.find_timeout)
+            doc_view.find_timeout = None
+        if doc_view.find_search is not None:
+            doc_view.find_search.cancel()
+            doc_view.find_search = None
+        if doc_view.find_job is not None:
+            doc_view.find_job.cancel()
             doc_view.find_job = None
             doc_view.view.find_cancel()
+
+    def start_find(self, doc_view):
+        """
+        Search the text of the find bar, after cancelling the search of
+        the previous text. The pages matching the last finished search
+        are known from its find job; when the new text extends that one
+        only those pages are looked at, through the page text cache, and
+        the find job starts at the first of them that still matches, or
+        is not run at all if none does.
+        """
+        doc_view.find_timeout = None
+        self.cancel_find(doc_view)
+        if doc_view.doc is None:
+            return False
+        search_string = doc_view.search_entry.get_text()
+        last = doc_view.find_pages
+        if not search_string:
+            doc_view.find_pages = None
+        elif last is not None and page_text.extends(search_string,
+                                                    last.query):
+            doc_view.find_search = page_text.cache.refine(
+                doc_view.doc_entry, search_string, last.pages,
+                self.find_refined, doc_view)
         else:
-            doc_view.find_job = EvinceView.JobFind.new(
-                doc_view.doc,
-                doc_view.model.get_page(),
-                doc_view.doc.get_n_pages(),
-                search_string,
-                False)
-            doc_view.view.find_search_changed()
-            doc_view.view.find_started(doc_view.find_job)
-            doc_view.find_job.scheduler_push_job(
-                EvinceView.JobPriority.PRIORITY_LOW)
+            self.push_find_job(doc_view, search_string,
+                               doc_view.model.get_page())
+        return False
+
+    def find_refined(self, search, doc_view):
+        if doc_view.find_search is not search:
+            return
+        doc_view.find_search = None
+        if not search.pages:
+            doc_view.find_pages = AttrDict(query=search.query, pages=[])
+            doc_view.view.find_cancel()
+            return
+        page = doc_view.model.get_page()
+        start = next((p for p in search.pages if p >= page), search.pages[0])
+        self.push_find_job(doc_view, search.query, start)
+
+    def push_find_job(self, doc_view, search_string, start_page):
+        doc_view.find_job = EvinceView.JobFind.new(
+            doc_view.doc,
+            start_page,
+            doc_view.doc.get_n_pages(),
+            search_string,
+            False)
+        doc_view.find_found = []
+        doc_view.find_job.connect("updated", self.find_updated, doc_view)
+        doc_view.find_job.connect(
+            "finished", self.find_finished, doc_view, search_string)
+        doc_view.view.find_search_changed()
+        doc_view.view.find_started(doc_view.find_job)
+        doc_view.find_job.scheduler_push_job(
+            EvinceView.JobPriority.PRIORITY_LOW)
+
+    def find_updated(self, job, page, doc_view):
+        if doc_view.find_job is job and job.get_n_results(page):
+            doc_view.find_found.append(page)
+
+    def find_finished(self, job, doc_view, search_string):
+        if doc_view.find_job is job and not job.is_cancelled():
+            # What the next search can be narrowed to
+            doc_view.find_pages = AttrDict(
+                query=search_string, pages=sorted(doc_view.find_found))
+
+    ####################################################################
+    # Find in all documents
+    ####################################################################
+
+    def on_action_search_all(self, *args):
+        self.search_all_box.show()
+        self.search_all_entry.grab_focus()
+
+    def on_action_search_all_close(self, *args):
+        self.cancel_search_all()
+        self.search_all_model.clear()
+        self.search_all_entry.set_text('')
+        self.search_all_box.hide()
+        doc_view = self.get_current_doc_view()
+        if doc_view:
+            doc_view.view.grab_focus()
+
+    def search_all_changed(self, search_entry):
+        if self.search_all_timeout is not None:
+            GLib.source_remove(self.search_all_timeout)
+        self.search_all_timeout = GLib.timeout_add(
+            self.find_delay, self.start_search_all)
+
+    def cancel_search_all(self, *args):
+        if self.search_all_timeout is not None:
+            GLib.source_remove(self.search_all_timeout)
+            self.search_all_timeout = None
+        self.search_all_serial += 1
+        for job in self.search_all_jobs.values():
+            job.cancel()
+        for entry in self.search_all_entries.values():
+            doc_registry.registry.release(entry)
+        self.search_all_jobs = {}
+        self.search_all_entries = {}
+        self.search_all_sizes = {}
+        self.search_all_pending = []
+        self.search_all_rows = {}
+
+    def start_search_all(self):
+        """
+        Search every tab of the window with low priority find jobs.
+        A tab that has its document loaded is searched in it; the
+        others are loaded one after the other for the time of their
+        search, and at most tab_memory_budget of them are held at once.
+        Pages are added to the results as the jobs report them.
+        """
+        self.search_all_timeout = None
+        self.cancel_search_all()
+        self.search_all_model.clear()
+        search_string = self.search_all_entry.get_text()
+        if not search_string:
+            return False
+        self.search_all_string = search_string
+        self.search_all_pending = [self.doc_views[row[1]]
+                                   for row in self.sidebar_model
+                                   if row[1] in self.doc_views]
+        self.search_all_next()
+        return False
+
+    def search_all_next(self):
+        serial = self.search_all_serial
+        while self.search_all_pending:
+            doc_view = self.search_all_pending[0]
+            if self.doc_views.get(doc_view.name) is not doc_view:
+                # Closed since
+                self.search_all_pending.pop(0)
+                continue
+            size = 0
+            if doc_view.doc is None:
+                try:
+                    size = os.path.getsize(doc_view.path)
+                except OSError:
+                    pass
+            if (self.search_all_sizes and sum(self.search_all_sizes.values())
+                    + size > self.tab_memory_budget):
+                return
+            self.search_all_pending.pop(0)
+            self.search_all_sizes[doc_view.name] = size
+            if doc_view.doc is not None:
+                entry = doc_registry.registry.hold(doc_view.doc_entry)
+                self.search_all_doc_loaded(entry, doc_view, serial)
+                continue
+            entry = self.acquire_doc(
+                doc_view.orig_path, doc_view.mime,
+                self.search_all_doc_loaded, doc_view, serial)
+            if doc_view.name in self.search_all_sizes:
+                self.search_all_entries.setdefault(doc_view.name, entry)
+
+    def search_all_doc_loaded(self, doc_entry, doc_view, serial):
+        if serial != self.search_all_serial:
+            # Released by cancel_search_all
+            return
+        self.search_all_entries[doc_view.name] = doc_entry
+        if doc_entry.doc is None:
+            self.search_all_done(doc_view)
+            return
+        job = EvinceView.JobFind.new(
+            doc_entry.doc, 0, doc_entry.doc.get_n_pages(),
+            self.search_all_string, False)
+        job.connect("updated", self.search_all_updated, doc_view, serial)
+        job.connect("finished", self.search_all_finished, doc_view, serial)
+        self.search_all_jobs[doc_view.name] = job
+        # Below the find bar and rendering of the visible tab
+        job.scheduler_push_job(EvinceView.JobPriority.PRIORITY_NONE)
+
+    def search_all_updated(self, job, page, doc_view, serial):
+        if (serial != self.search_all_serial
+                or self.doc_views.get(doc_view.name) is not doc_view
+                or not job.get_n_results(page)):
+            return
+        row = self.search_all_rows.get(doc_view.name)
+        if row is None:
+            itr = self.search_all_model.append(
+                None, [doc_view.title, doc_view.name, -1])
+            row = self.search_all_rows[doc_view.name] = [itr, 0]
+        row[1] += 1
+        self.search_all_model.set_value(
+            row[0], 0, "{} ({})".format(doc_view.title, row[1]))
+        self.search_all_model.append(
+            row[0], ["Page {}".format(page + 1), doc_view.name, page])
+        if row[1] == 1:
+            self.search_all_treeview.expand_row(
+                self.search_all_model.get_path(row[0]), False)
+
+    def search_all_finished(self, job, doc_view, serial):
+        if serial == self.search_all_serial:
+            self.search_all_done(doc_view)
+
+    def search_all_done(self, doc_view):
+        self.search_all_jobs.pop(doc_view.name, None)
+        self.search_all_sizes.pop(doc_view.name, None)
+        entry = self.search_all_entries.pop(doc_view.name, None)
+        if entry is not None:
+            doc_registry.registry.release(entry)
+        self.search_all_next()
+
+    def search_all_selection_changed(self, tree_view):
+        cursor, col = self.search_all_treeview.get_cursor()
+        if not cursor:
+            return
+        itr = self.search_all_model.get_iter(cursor)
+        name, page = self.search_all_model.get(itr, 1, 2)
+        doc_view = self.doc_views.get(name)
+        if doc_view is None:
+            # Closed since
+            return
+        if page < 0:
+            child = self.search_all_model.iter_children(itr)
+            page = self.search_all_model.get_value(child, 2)
+        doc_view.find_result = (page, self.search_all_string)
+        # Applied by doc_loaded if the tab has to be loaded first
+        self.select_doc_view(doc_view)
+        if doc_view.doc is not None and doc_view.find_result is not None:
+            self.apply_find_result(doc_view)
+
+    def apply_find_result(self, doc_view):
+        """
+        Show the page of a result of the search in all documents, with
+        the matches highlighted by the find bar of the tab.
+        """
+        page, search_string = doc_view.find_result
+        doc_view.find_result = None
+        doc_view.model.set_page(page)
+        doc_view.search_entry.set_text(search_string)
 
     ####################################################################
     # Reload opened file
     ####################################################################
 
     def on_action_reload(self, *args):
+        """
+        Reload the file of the current tab in a worker thread. The
+        document is shared by every tab showing the same file, in every
+        window: they all show the loading placeholder and get the new
+        document, at the same place, through doc_loaded as when opened.
+        """
         doc_view = self.get_current_doc_view()
-        if doc_view:
-            print(doc_view.path, doc_view.orig_path)
-            doc_view.doc.load('file://' + doc_view.path)
-            doc_view.view.reload()
+        if doc_view is None or doc_view.doc_entry.loading:
+            return
+        doc_entry = doc_view.doc_entry
+        load = self.doc_loader(doc_view.orig_path, doc_view.mime)
+        for window in self.app.get_pulp_windows():
+            for other in list(window.doc_views.values()):
+                if other.doc_entry is doc_entry and other.doc is not None:
+                    restore = AttrDict(sync_data=window.get_sync_data(other))
+                    window.show_reloading(other)
+                    doc_registry.registry.reload(
+                        doc_entry, load, window.doc_loaded, other, restore)
+
+    def show_reloading(self, doc_view):
+        self.cancel_find(doc_view)
+        doc_view.find_pages = None
+        doc_view.doc = None
+        doc_view.scroll.hide()
+        doc_view.loading_label.set_text(
+            "Loading {}...".format(doc_view.title))
+        doc_view.loading_label.show()
+        if self.stack.get_visible_child_name() == doc_view.name:
+            self.page_changed(doc_view)
 
     ####################################################################
     # Duplicate opened file
@@ -905,6 +1371,8 @@ class PulpWindow(Gtk.ApplicationWindow):
         doc_view = self.get_current_doc_view()
         if doc_view:
             bwin = bib_window.BibWindow(self.app, doc_view.orig_path)
+            doc_view.bib_windows.append(bwin)
+            bwin.connect("destroy", doc_view.bib_windows.remove)
             bwin.show()
 
     # def load_bibtex(self, bibtex_container, doc_view):
@@ -966,7 +1434,10 @@ class PulpApplication(Gtk.Application):
         self.setup_menu()
         self.setup_actions()
         self.setup_tempdir()
-        self._fds_debug = FdsDebug()
+        self.resource_monitor = resource_monitor.ResourceMonitor()
+        self.resource_monitor.start()
+        self.session_restored = False
+        GLib.timeout_add_seconds(self.session_interval, self.save_session)
         self._startup_done = True
 
     def start_server(self):
@@ -994,6 +1465,7 @@ class PulpApplication(Gtk.Application):
             action.connect('activate', callback)
             self.add_action(action)
         add_simple_action("newwindow", self.on_action_new_window)
+        add_simple_action("resources", self.on_action_resources)
 
     def setup_tempdir(self):
         self.tempdir = tempfile.mkdtemp()
@@ -1002,6 +1474,39 @@ class PulpApplication(Gtk.Application):
     # Quit if no windows are opened
     ####################################################################
 
+    ####################################################################
+    # Session
+    ####################################################################
+
+    session_interval = 30
+
+    def get_pulp_windows(self):
+        return [window for window in self.get_windows()
+                if isinstance(window, PulpWindow)]
+
+    def save_session(self, wait=False):
+        windows = self.get_pulp_windows()
+        if windows:
+            session.store.save(
+                dict(windows=[window.get_session() for window in windows]),
+                wait)
+        return True
+
+    def restore_session(self):
+        self.session_restored = True
+        saved = session.store.load()
+        if not saved:
+            return []
+        windows = []
+        for win_session in saved.get('windows', []):
+            window = PulpWindow(self)
+            window.show_all()
+            window.restore_session(win_session)
+            windows.append(window)
+        return windows
+
+    ####################################################################
+
     def quit_if_needed(self):
         windows = self.get_windows()
         if not windows:
@@ -1012,6 +1517,12 @@ class PulpApplication(Gtk.Application):
     ####################################################################
     
     def do_shutdown(self):
+        self.save_session(wait=True)
+        for window in self.get_pulp_windows():
+            for doc_view in window.doc_views.values():
+                if doc_view.doc is not None:
+                    window.save_reading_state(doc_view)
+        reading_state.store.flush()
         try:
             shutil.rmtree(self.tempdir)
         except:
@@ -1029,14 +1540,19 @@ class PulpApplication(Gtk.Application):
         if not self._startup_done:
             self.do_startup()
         window = self.get_windows()
+        if not window and not self.session_restored:
+            window = self.restore_session()
         if window:
             window = window[0]
         else:
             window = PulpWindow(self)
             window.show_all()
+        doc_view = None
         for file in files:
             path = file.get_path()
-            window.open_file(path, None, True)
+            doc_view = window.open_file(path, None, True, lazy=True)
+        if doc_view is not None:
+            window.select_doc_view(doc_view)
         window.present()
 
     def do_open_mac(self, osx_app, path, *args):
@@ -1047,6 +1563,10 @@ class PulpApplication(Gtk.Application):
     # New Window
     ####################################################################
 
+    def on_action_resources(self, *args):
+        print(self.resource_monitor.report(), end="")
+        print(bib_fetcher.bib_stats.report(), end="")
+
     def on_action_new_window(self, *args):
         new_win = PulpWindow(self)
         new_win.show_all()
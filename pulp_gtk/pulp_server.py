@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import multiprocessing
 import re
 import os
 import subprocess
+import threading
+import time
 import urllib.parse
 import wsgiref.simple_server
 
+from . import bib_async
+from . import bib_entry
+from . import bib_fetcher
+
 class PulpRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
     def log_message(self, fmt, *args):
         print("PulpServer: %s [%s] %s" %
@@ -17,6 +24,28 @@ class PulpRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
 
 class PulpServer:
 
+    library_dir = "/Users/roi/Google Drive/Zotero"
+    index_refresh_interval = 30
+
+    def __init__(self):
+        # Requests are served from the loaded index; the directories are
+        # only rescanned by the refresh thread (and files written by
+        # this process update it through BibIndex.notify)
+        self.index = bib_entry.BibIndex.get(refresh=False)
+        self.index.refresh(force=True)
+        self.fetch_lock = threading.Lock()
+        self.fetching = set()
+        thread = threading.Thread(target=self.refresh_index, daemon=True)
+        thread.start()
+
+    def refresh_index(self):
+        while True:
+            time.sleep(self.index_refresh_interval)
+            try:
+                self.index.refresh(force=True)
+            except Exception as e:
+                print("PulpServer: refreshing the bib index failed:", e)
+
     @classmethod
     def start_multiprocess(cls):
         proc = multiprocessing.Process(
@@ -42,6 +71,13 @@ class PulpServer:
 
         response_body = ""
 
+        if path == "/bibtex":
+            return self.get_bibtex(query, start_response)
+        elif path == "/bibtex_export":
+            return self.get_bibtex_export(query, start_response)
+        elif path == "/bib_stats":
+            return self.get_bib_stats(start_response)
+
         if path == "/list":
             response_body = self.get_list()
         elif path == "/short_list":
@@ -71,7 +107,7 @@ class PulpServer:
         return self.gen_file_list(filter_fun, indent=None)
 
     def gen_file_list(self, filter_fun, indent=2):
-        files = os.listdir("/Users/roi/Google Drive/Zotero")
+        files = os.listdir(self.library_dir)
         dics = []
         rgx = re.compile(r"""
                          (?P<file_name>
@@ -99,7 +135,7 @@ class PulpServer:
         return json.dumps(dics, indent=indent)
 
     def get_search(self, query):
-        files = os.listdir("/Users/roi/Google Drive/Zotero")
+        files = os.listdir(self.library_dir)
         query = urllib.parse.unquote_plus(query)
         q_rgx = re.sub(r"[^a-zA-Z\d]+", ".*", query)
         rgx = re.compile(r"""
@@ -124,10 +160,136 @@ class PulpServer:
 
     def do_open(self, query):
         file_name = urllib.parse.unquote_plus(query)
-        file_path = os.path.join("/Users/roi/Google Drive/Zotero", file_name)
+        file_path = os.path.join(self.library_dir, file_name)
         if os.path.exists(file_path):
             subprocess.call(["open", file_path])
 
+    ########################################################
+    # Bibtex entries
+    ########################################################
+
+    bibtex_content_type = 'text/x-bibtex; charset=utf-8'
+
+    def get_bibtex(self, query, start_response):
+        """
+        /bibtex?file=<file name> or /bibtex?key=<key, DOI, MR number or
+        arXiv id>. Only the cache and the personal entries are used.
+        With fetch=1 and a file that has none, the lookup is started on
+        the BibEngine and 202 is returned; ask again later.
+        """
+        params = urllib.parse.parse_qs(query)
+        fetch = params.get('fetch', ['0'])[0] == '1'
+        index = self.index
+        bibtex = None
+        if 'file' in params:
+            bibtex = self.file_bibtex(index, params['file'][0], fetch)
+        elif 'key' in params:
+            entry = index.lookup(params['key'][0])
+            if entry is not None:
+                bibtex = entry.to_bibtex()
+        if bibtex is self.fetching_bibtex:
+            status = '202 Accepted'
+            response_body = bibtex
+        elif bibtex is None:
+            status = '404 Not Found'
+            response_body = "% No bibtex entry found.\n"
+        else:
+            status = '200 OK'
+            response_body = bibtex
+        response_body = response_body.encode('utf-8')
+        start_response(status, [
+            ('Content-Type', self.bibtex_content_type),
+            ('Content-Length', str(len(response_body)))
+        ])
+        return [response_body]
+
+    def get_bibtex_export(self, query, start_response):
+        """
+        /bibtex_export?file=<name>&file=<name>... streams one .bib with
+        the entries of the given files, or of the whole library when no
+        file is given.
+        """
+        params = urllib.parse.parse_qs(query)
+        fetch = params.get('fetch', ['0'])[0] == '1'
+        index = self.index
+        start_response('200 OK', [
+            ('Content-Type', self.bibtex_content_type)
+        ])
+        if 'file' in params:
+            return self.gen_file_bibtex(index, params['file'], fetch)
+        else:
+            return self.gen_library_bibtex(index)
+
+    def get_bib_stats(self, start_response):
+        """
+        /bib_stats gives bib_fetcher.bib_stats.summary() of the lookups
+        made by this server as JSON.
+        """
+        response_body = json.dumps(
+            {str(source): stats for source, stats
+             in bib_fetcher.bib_stats.summary().items()},
+            indent=2, sort_keys=True).encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(response_body)))
+        ])
+        return [response_body]
+
+    def gen_file_bibtex(self, index, file_names, fetch):
+        for file_name in file_names:
+            bibtex = self.file_bibtex(index, file_name, fetch)
+            if bibtex is None:
+                bibtex = "% No bibtex entry found.\n"
+            yield ("% {}\n{}\n".format(file_name, bibtex)).encode('utf-8')
+
+    def gen_library_bibtex(self, index):
+        # The refresh thread replaces records meanwhile; stream the
+        # records of one version of the index
+        with index.mutex:
+            records = sorted(index.records.items())
+        for basename, record in records:
+            if not record.entries:
+                continue
+            yield ("% {}\n{}\n".format(basename, record.bibtex)).encode('utf-8')
+
+    def file_bibtex(self, index, file_name, fetch):
+        file_name = os.path.basename(file_name)
+        m = bib_fetcher.BibFetcher.rgx.match(file_name)
+        if m:
+            basename = m.group('basename')
+        else:
+            basename = os.path.splitext(file_name)[0]
+        record = index.by_basename(basename)
+        if record is not None and record.entries:
+            return record.bibtex
+        file_path = os.path.join(self.library_dir, file_name)
+        if not fetch or not os.path.exists(file_path):
+            return None
+        self.fetch_in_background(file_path)
+        return self.fetching_bibtex
+
+    fetching_bibtex = "% Fetching the bibtex entry, ask again later.\n"
+
+    def fetch_in_background(self, file_path):
+        """
+        Look up the bibtex of file_path on the BibEngine and save it to
+        the cache, which adds it to the index.
+        """
+        with self.fetch_lock:
+            if file_path in self.fetching:
+                return
+            self.fetching.add(file_path)
+        async def fetch():
+            try:
+                fetcher = bib_async.AsyncBibFetcher(file_path)
+                await fetcher.fetch()
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, fetcher.save_cache_bib)
+            finally:
+                with self.fetch_lock:
+                    self.fetching.discard(file_path)
+        bib_async.BibEngine.get().submit(fetch())
+
 start_pulp_server = PulpServer.start_multiprocess
 
 if __name__ == "__main__":
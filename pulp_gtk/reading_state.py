@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+############################################################
+# Where each document was left
+############################################################
+
+class ReadingStateStore:
+    """
+    The last page, scroll offsets, zoom, sizing mode and continuous flag
+    of every document, keyed by its real path. The store is read once,
+    on the first lookup, and kept in a dict; changes are written back by
+    a timer thread flush_delay seconds after the first unsaved change,
+    so a burst of page changes costs one write. Only the max_entries
+    most recently read documents are kept.
+    """
+
+    path = os.path.join(os.path.expanduser("~"), ".pulp-state", "reading.json")
+    flush_delay = 2.0
+    max_entries = 5000
+
+    def __init__(self, path=None):
+        if path is not None:
+            self.path = path
+        self.states = None
+        self.lock = threading.Lock()
+        # Held from the snapshot to the rename, so that the timer and a
+        # flush at shutdown write one after the other, newest last
+        self.write_lock = threading.Lock()
+        self.timer = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as state_file:
+                states = json.load(state_file)
+        except (OSError, ValueError):
+            states = {}
+        if not isinstance(states, dict):
+            states = {}
+        return states
+
+    def get(self, path):
+        with self.lock:
+            if self.states is None:
+                self.states = self.load()
+            return self.states.get(os.path.realpath(path))
+
+    def put(self, path, state):
+        state = dict(state, time=time.time())
+        with self.lock:
+            if self.states is None:
+                self.states = self.load()
+            self.states[os.path.realpath(path)] = state
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if self.states is None:
+                    return
+                if len(self.states) > self.max_entries:
+                    paths = sorted(self.states,
+                                   key=lambda p: self.states[p].get("time", 0))
+                    for old_path in paths[:len(paths) - self.max_entries]:
+                        del self.states[old_path]
+                data = json.dumps(self.states, separators=(",", ":"))
+            self.write(data)
+
+    def write(self, data):
+        directory = os.path.dirname(self.path)
+        tmp_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".", suffix=".tmp", dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            print("Saving the reading state failed.")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+store = ReadingStateStore()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import collections
+import ctypes
+import ctypes.util
+import os
+import os.path
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import fd_tracker
+
+############################################################
+# Samples of this process
+############################################################
+
+def rss_bytes():
+    """
+    Current resident set size, from /proc on Linux or proc_pidinfo on
+    macOS; None if neither works.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    info = mach_task_info()
+    return info.pti_resident_size if info is not None else None
+
+def peak_rss_bytes():
+    """
+    The peak resident set size reported by getrusage. It never goes
+    down, so it cannot show a leak being fixed.
+    """
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+class ProcTaskInfo(ctypes.Structure):
+    _fields_ = [("pti_virtual_size", ctypes.c_uint64),
+                ("pti_resident_size", ctypes.c_uint64),
+                ("pti_total_user", ctypes.c_uint64),
+                ("pti_total_system", ctypes.c_uint64),
+                ("pti_threads_user", ctypes.c_uint64),
+                ("pti_threads_system", ctypes.c_uint64),
+                ("pti_policy", ctypes.c_int32),
+                ("pti_faults", ctypes.c_int32),
+                ("pti_pageins", ctypes.c_int32),
+                ("pti_cow_faults", ctypes.c_int32),
+                ("pti_messages_sent", ctypes.c_int32),
+                ("pti_messages_received", ctypes.c_int32),
+                ("pti_syscalls_mach", ctypes.c_int32),
+                ("pti_syscalls_unix", ctypes.c_int32),
+                ("pti_csw", ctypes.c_int32),
+                ("pti_threadnum", ctypes.c_int32),
+                ("pti_numrunning", ctypes.c_int32),
+                ("pti_priority", ctypes.c_int32)]
+
+PROC_PIDTASKINFO = 4
+
+libproc = None
+
+def mach_task_info():
+    """
+    The proc_taskinfo of this process on macOS (resident size and
+    thread count, among others), read in process; None elsewhere.
+    """
+    global libproc
+    if sys.platform != "darwin":
+        return None
+    try:
+        if libproc is None:
+            libproc = ctypes.CDLL(ctypes.util.find_library("proc")
+                                  or ctypes.util.find_library("c"))
+        info = ProcTaskInfo()
+        size = libproc.proc_pidinfo(os.getpid(), PROC_PIDTASKINFO, 0,
+                                    ctypes.byref(info), ctypes.sizeof(info))
+    except (OSError, AttributeError, TypeError):
+        return None
+    if size != ctypes.sizeof(info):
+        return None
+    return info
+
+def thread_count():
+    """
+    Number of OS threads of the process, GLib, Evince and poppler
+    threads included, from /proc on Linux or proc_pidinfo on macOS;
+    None if neither works.
+    """
+    try:
+        return len(os.listdir("/proc/self/task"))
+    except OSError:
+        pass
+    info = mach_task_info()
+    return info.pti_threadnum if info is not None else None
+
+def current_rss():
+    """
+    Return (bytes, label): the current RSS, or the peak RSS labelled as
+    such where the current one cannot be read.
+    """
+    rss = rss_bytes()
+    if rss is None:
+        return peak_rss_bytes(), "peak rss"
+    return rss, "rss"
+
+def current_threads():
+    """
+    Return (count, label): the OS threads, or only the Python threads
+    labelled as such where the OS count cannot be read.
+    """
+    threads = thread_count()
+    if threads is None:
+        return threading.active_count(), "python threads"
+    return threads, "threads"
+
+############################################################
+# Monitor
+############################################################
+
+class ResourceMonitor:
+    """
+    Samples the open descriptors, the resident size and the number of
+    threads every interval seconds in a background thread. Only the
+    changes are kept, in a ring buffer of the last size samples; the
+    path of a descriptor is read once, when it appears.
+
+    PULP_MONITOR_INTERVAL sets the interval; 0 disables the monitor.
+    """
+
+    instance = None
+
+    interval = float(os.environ.get("PULP_MONITOR_INTERVAL", "5"))
+    size = 500
+    rss_threshold = 2**20
+
+    def __init__(self, interval=None, size=None):
+        if interval is not None:
+            self.interval = interval
+        if size is not None:
+            self.size = size
+        self.samples = collections.deque(maxlen=self.size)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.fds = {}
+        self.rss = 0
+        self.threads = 0
+        self.rss_label = "rss"
+        self.threads_label = "threads"
+        self.thread = None
+        ResourceMonitor.instance = self
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.sample()
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    @classmethod
+    def log(cls, event, path):
+        """
+        Record an event, e.g. a document being opened or closed, so that
+        the next changes can be related to it.
+        """
+        monitor = cls.instance
+        if monitor is not None:
+            with monitor.lock:
+                monitor.samples.append(dict(
+                    time=time.time(), event=event, path=path))
+
+    def sample(self):
+        fds = fd_tracker.open_fds()
+        opened = sorted(fd for fd in fds if fd not in self.fds)
+        closed = sorted(fd for fd in self.fds if fd not in fds)
+        for fd in closed:
+            del self.fds[fd]
+        for fd in opened:
+            self.fds[fd] = fd_tracker.fd_path(fd)
+        rss, self.rss_label = current_rss()
+        threads, self.threads_label = current_threads()
+        record = dict(
+            time = time.time(),
+            fds = len(fds), rss = rss, threads = threads,
+            opened = [(fd, self.fds[fd]) for fd in opened],
+            closed = closed,
+            rss_delta = rss - self.rss,
+            threads_delta = threads - self.threads)
+        # Small changes of the resident size add up until they are
+        # worth a sample
+        rss_changed = abs(record["rss_delta"]) >= self.rss_threshold
+        if rss_changed:
+            self.rss = rss
+        self.threads = threads
+        if opened or closed or rss_changed or record["threads_delta"]:
+            with self.lock:
+                self.samples.append(record)
+        return record
+
+    ########################################################
+    # Report
+    ########################################################
+
+    def report(self):
+        with self.lock:
+            samples = list(self.samples)
+        lines = ["fds: %d   %s: %.1f MB   %s: %d" % (
+            len(self.fds), self.rss_label, self.rss / 2**20,
+            self.threads_label, self.threads)]
+        for s in samples:
+            stamp = time.strftime("%H:%M:%S", time.localtime(s["time"]))
+            if "event" in s:
+                lines.append("%s %s %s" % (stamp, s["event"], s["path"]))
+                continue
+            line = "%s fds %d  %s %+.1f MB  %s %+d" % (
+                stamp, s["fds"], self.rss_label, s["rss_delta"] / 2**20,
+                self.threads_label, s["threads_delta"])
+            for fd, path in s["opened"]:
+                line += "\n    + %d %s" % (fd, path)
+            if s["closed"]:
+                line += "\n    - " + " ".join(map(str, s["closed"]))
+            lines.append(line)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import os.path
+import tempfile
+import threading
+
+############################################################
+# Snapshots of the open windows and tabs
+############################################################
+
+class SessionStore:
+    """
+    The last snapshot of the session: every window with its geometry
+    and its tabs in sidebar order. save() hands the snapshot to a writer
+    thread; the file is fsynced and then renamed over the previous one,
+    so a crash leaves either the old or the new snapshot.
+    """
+
+    path = os.path.join(os.path.expanduser("~"), ".pulp-state", "session.json")
+
+    def __init__(self, path=None):
+        if path is not None:
+            self.path = path
+        self.lock = threading.Lock()
+        self.pending = None
+        self.last_data = None
+        self.thread = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as session_file:
+                session = json.load(session_file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(session, dict):
+            return None
+        return session
+
+    def save(self, session, wait=False):
+        data = json.dumps(session, separators=(",", ":"))
+        with self.lock:
+            if data == self.last_data:
+                return
+            self.pending = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.writer, daemon=True)
+                self.thread.start()
+            thread = self.thread
+        if wait:
+            thread.join()
+
+    def writer(self):
+        while True:
+            with self.lock:
+                data = self.pending
+                self.pending = None
+                if data is None:
+                    self.thread = None
+                    return
+            if self.write(data):
+                with self.lock:
+                    self.last_data = data
+
+    def write(self, data):
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".", suffix=".tmp", dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            print("Saving the session failed.")
+            return False
+        return True
+
+store = SessionStore()
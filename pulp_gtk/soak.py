@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Open and close the same documents in a Pulp window over and over, and
+print the resident size, descriptors and threads every so often. A leak
+in the tab lifecycle shows up as a steadily growing RSS.
+
+    python3 -m pulp_gtk.soak paper.pdf scan.djvu --cycles 2000
+
+The run passes (exit status 0) if the RSS at the end is at most
+--max-growth MB above the RSS after --warmup cycles, the caches of
+GLib, Evince and the backends having filled by then, and if the
+descriptors and threads are back to their level after warm-up. A load
+that fails still completes its cycle and is counted.
+
+The document LRU is disabled so that every cycle loads and releases the
+documents. The session and the reading state are kept in a temporary
+directory, away from the real ones.
+"""
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+from gi.repository import GLib
+
+from . import doc_registry
+from . import fd_tracker
+from . import pulp
+from . import reading_state
+from . import resource_monitor
+from . import session
+
+class SoakApplication(pulp.PulpApplication):
+
+    __gtype_name__ = 'PulpSoakApplication'
+
+    soak = None
+
+    def do_activate(self):
+        self.hold()
+        self.soak.run()
+
+class Soak:
+
+    def __init__(self, app, paths, cycles, report_every,
+                 warmup=50, max_growth=20 * 2**20):
+        self.app = app
+        self.paths = paths
+        self.cycles = cycles
+        self.report_every = report_every
+        self.warmup = min(warmup, max(cycles - 1, 0))
+        self.max_growth = max_growth
+        self.cycle = 0
+        self.window = None
+        self.pending = []
+        self.loads = 0
+        self.failed_loads = 0
+        self.baseline = None
+        self.passed = None
+        self.start = time.perf_counter()
+
+    def run(self):
+        self.window = pulp.PulpWindow(self.app)
+        self.window.show_all()
+        self.report()
+        GLib.idle_add(self.open_all)
+
+    def open_all(self):
+        self.pending = [self.window.open_file(path, None, True)
+                        for path in self.paths]
+        GLib.timeout_add(20, self.close_when_loaded)
+        return False
+
+    def close_when_loaded(self):
+        if any(dv.doc_entry is not None and dv.doc_entry.loading
+               for dv in self.pending):
+            return True
+        self.loads += len(self.pending)
+        self.failed_loads += sum(dv.doc is None for dv in self.pending)
+        for _ in self.pending:
+            self.window.on_action_close()
+        self.window.close_history.clear()
+        self.cycle += 1
+        if self.cycle % self.report_every == 0:
+            self.report()
+        if self.cycle == self.warmup:
+            self.baseline = self.measure()
+        if self.cycle >= self.cycles:
+            self.check()
+            self.window.destroy()
+            self.app.release()
+            self.app.quit()
+        else:
+            GLib.idle_add(self.open_all)
+        return False
+
+    def measure(self):
+        return (resource_monitor.current_rss()[0],
+                len(fd_tracker.open_fds()),
+                resource_monitor.current_threads()[0])
+
+    def check(self):
+        rss, fds, threads = self.measure()
+        base_rss, base_fds, base_threads = self.baseline or self.measure()
+        growth = rss - base_rss
+        failures = []
+        if growth > self.max_growth:
+            failures.append("rss grew %.1f MB after warm-up (limit %.1f MB)"
+                            % (growth / 2**20, self.max_growth / 2**20))
+        if fds > base_fds:
+            failures.append("%d more descriptors" % (fds - base_fds))
+        if threads > base_threads:
+            failures.append("%d more threads" % (threads - base_threads))
+        if self.loads and self.failed_loads == self.loads:
+            failures.append("every load failed")
+        self.report()
+        print("loads %d, failed %d" % (self.loads, self.failed_loads))
+        print("rss growth after %d warm-up cycles: %+.1f MB" % (
+            self.warmup, growth / 2**20))
+        self.passed = not failures
+        print("PASS" if self.passed else "FAIL: " + "; ".join(failures),
+              flush=True)
+
+    def report(self):
+        rss, rss_label = resource_monitor.current_rss()
+        threads, threads_label = resource_monitor.current_threads()
+        print("cycle %6d   %7.1f s   %s %7.1f MB   fds %4d   %s %3d" % (
+            self.cycle, time.perf_counter() - self.start,
+            rss_label, rss / 2**20,
+            len(fd_tracker.open_fds()),
+            threads_label, threads), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Open/close soak run of the Pulp tab lifecycle.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--cycles", type=int, default=1000)
+    parser.add_argument("--report-every", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="cycles before the RSS baseline is taken")
+    parser.add_argument("--max-growth", type=float, default=20,
+                        help="allowed RSS growth after warm-up, in MB")
+    args = parser.parse_args()
+    doc_registry.DocRegistry.cache_budget = 0
+    state_dir = tempfile.mkdtemp(prefix="pulp-soak-")
+    session.store.path = os.path.join(state_dir, "session.json")
+    reading_state.store.path = os.path.join(state_dir, "reading.json")
+    app = SoakApplication()
+    app.soak = Soak(app, [os.path.abspath(p) for p in args.paths],
+                    args.cycles, args.report_every,
+                    args.warmup, int(args.max_growth * 2**20))
+    try:
+        app.run([])
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    sys.exit(0 if app.soak.passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+pytest.importorskip("unidecode")
+
+from pulp_gtk import bib_entry
+from pulp_gtk import bib_export
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(bib_entry.BibIndex, "cache_dir",
+                        str(tmp_path / "cache"))
+    monkeypatch.setattr(bib_entry.BibIndex, "personal_dir",
+                        str(tmp_path / "personal"))
+    os.makedirs(bib_entry.BibIndex.cache_dir)
+    return bib_entry.BibIndex()
+
+@pytest.fixture
+def parses(monkeypatch):
+    calls = []
+    parse_bibtex = bib_entry.parse_bibtex
+    def counting_parse(text, source=None):
+        calls.append(text)
+        return parse_bibtex(text, source)
+    monkeypatch.setattr(bib_entry, "parse_bibtex", counting_parse)
+    return calls
+
+def write_cache(name, text):
+    path = os.path.join(bib_entry.BibIndex.cache_dir, name + ".bib")
+    with open(path, "w", encoding="utf-8") as bib_file:
+        bib_file.write(text)
+
+def test_unchanged_files_are_not_parsed_again(tmp_path, index, parses):
+    write_cache("Tao_2010_Foo", "@article{MR1, title={Foo}}\n")
+    write_cache("Serre_1956_GAGA", "% No MathSciNet entry found.\n")
+    export = bib_export.BibExport(str(tmp_path / "library.bib"), index)
+
+    counts = export.update()
+    assert counts["added"] == 1
+    assert len(parses) == 2
+
+    del parses[:]
+    counts = export.update()
+    assert counts == dict(added=0, changed=0, removed=0, kept=1)
+    assert parses == []
+
+def test_placeholder_replacing_an_entry_removes_its_block(
+        tmp_path, index, parses):
+    write_cache("Tao_2010_Foo", "@article{MR1, title={Foo}}\n")
+    export = bib_export.BibExport(str(tmp_path / "library.bib"), index)
+    export.update()
+    write_cache("Tao_2010_Foo", "% No MathSciNet entry found.\n")
+    os.utime(os.path.join(bib_entry.BibIndex.cache_dir, "Tao_2010_Foo.bib"),
+             ns=(1, 1))
+
+    counts = export.update()
+    assert counts["removed"] == 1
+    with open(export.master_path, encoding="utf-8") as master_file:
+        assert "pulp-bib" not in master_file.read()
+    del parses[:]
+    export.update()
+    assert parses == []
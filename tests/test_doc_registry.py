@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+gi = pytest.importorskip("gi")
+try:
+    gi.require_version('EvinceDocument', '3.0')
+except ValueError:
+    pytest.skip("EvinceDocument is not available", allow_module_level=True)
+
+from gi.repository import GLib
+from gi.repository import EvinceDocument
+
+from pulp_gtk import doc_registry
+
+def write_pdf(path, text):
+    """
+    A one page PDF showing text, with a correct xref table.
+    """
+    stream = "BT /F1 24 Tf 72 720 Td ({}) Tj ET".format(text)
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        "/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        "<< /Length {} >>\nstream\n{}\nendstream".format(len(stream), stream),
+    ]
+    out = "%PDF-1.4\n"
+    offsets = []
+    for n, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += "{} 0 obj\n{}\nendobj\n".format(n, obj)
+    xref = len(out)
+    out += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1)
+    out += "".join("{:010d} 00000 n \n".format(o) for o in offsets)
+    out += "trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+        len(objects) + 1, xref)
+    with open(path, "w", encoding="latin-1") as pdf_file:
+        pdf_file.write(out)
+
+def wait_for(condition, timeout=30):
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        context.iteration(False)
+        time.sleep(0.005)
+
+def test_concurrent_loads_through_the_registry(tmp_path):
+    EvinceDocument.init()
+    paths = []
+    for n in range(12):
+        path = str(tmp_path / "doc{}.pdf".format(n))
+        write_pdf(path, "Document {}".format(n))
+        paths.append(path)
+    registry = doc_registry.DocRegistry()
+    loaded = []
+    def load(path):
+        return (doc_registry.load_document(
+            "application/pdf", "file://" + path), path)
+    for path in paths:
+        registry.acquire(path, "application/pdf",
+                         lambda path=path: load(path),
+                         lambda entry: loaded.append(entry))
+    wait_for(lambda: len(loaded) == len(paths))
+    assert all(entry.doc is not None for entry in loaded)
+    assert all(entry.doc.get_n_pages() == 1 for entry in loaded)
+
+def test_loads_overlap(monkeypatch):
+    """
+    Loads run in parallel, and none waits for the document mutex that
+    the render and find jobs of the open documents hold.
+    """
+    state = dict(running=0, max_running=0, parsing=0, max_parsing=0)
+    lock = threading.Lock()
+    def enter(name):
+        with lock:
+            state[name] += 1
+            state["max_" + name] = max(state["max_" + name], state[name])
+    def leave(name):
+        with lock:
+            state[name] -= 1
+    class FakeDoc:
+        def load(self, uri):
+            enter("parsing")
+            time.sleep(0.01)
+            leave("parsing")
+    class FakeDocument:
+        mutexes = dict(doc=threading.Lock(), fc=threading.Lock())
+        doc_mutex_lock = mutexes["doc"].acquire
+        doc_mutex_unlock = mutexes["doc"].release
+        fc_mutex_lock = mutexes["fc"].acquire
+        fc_mutex_unlock = mutexes["fc"].release
+    class FakeEvinceDocument:
+        Document = FakeDocument
+        @staticmethod
+        def backends_manager_get_document(mime):
+            return FakeDoc()
+    monkeypatch.setattr(doc_registry, "EvinceDocument", FakeEvinceDocument)
+    def load(n):
+        enter("running")
+        # Converting or symlinking the file, tracking its descriptors
+        time.sleep(0.05)
+        doc = doc_registry.load_document(
+            "application/pdf", "file:///{}".format(n))
+        leave("running")
+        return doc, str(n)
+    registry = doc_registry.DocRegistry()
+    loaded = []
+    # A render job is running
+    FakeDocument.doc_mutex_lock()
+    try:
+        for n in range(8):
+            registry.acquire(
+                "/nonexistent/{}.pdf".format(n), "application/pdf",
+                lambda n=n: load(n), lambda entry: loaded.append(entry))
+        wait_for(lambda: len(loaded) == 8)
+    finally:
+        FakeDocument.doc_mutex_unlock()
+    assert all(entry.doc is not None for entry in loaded)
+    assert state["max_running"] > 1
+    # The backends still parse one at a time, under the fontconfig mutex
+    assert state["max_parsing"] == 1